@@ -0,0 +1,218 @@
+import time
+import bisect
+import random
+import logging
+import threading
+
+from metrics import count
+
+# Client for every Appen API call the pipeline makes: job JSON, report regeneration and download,
+# annotation fetch and upload. One pooled session with TLS verification, a token bucket on the
+# request rate, a concurrency limit that backs off on 429s and 5xxs, and latency histograms per endpoint.
+
+logger = logging.getLogger()
+
+
+class TokenBucket:
+    '''
+    Lets through rate requests per second on average, and bursts of up to burst requests
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''
+        Blocks until a request may be sent
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    '''
+    Caps the requests in flight. The cap halves on every 429, 5xx or connection error and grows
+    by one after as many successes in a row as the cap, between minimum and maximum.
+    '''
+
+    def __init__(self, start, minimum=1, maximum=64):
+        self.limit = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class LatencyHistogram:
+    '''
+    Counts request latencies into fixed millisecond buckets
+    '''
+
+    bounds_ms = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.total_ms = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, ms):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds_ms, ms)] += 1
+            self.total_ms += ms
+
+    def percentile(self, counts, p):
+        '''
+        Returns the upper bound of the bucket holding the p-th percentile, None past the last bound
+        '''
+        rank = p / 100 * sum(counts)
+        seen = 0
+        for bucket, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds_ms[bucket] if bucket < len(self.bounds_ms) else None
+
+    def summary(self):
+        with self.lock:
+            counts = list(self.counts)
+            total_ms = self.total_ms
+        n = sum(counts)
+        buckets = {f'<={bound}': bucket for bound, bucket in zip(self.bounds_ms, counts)}
+        buckets['more'] = counts[-1]
+        return {
+            'count': n,
+            'mean_ms': round(total_ms / n, 1) if n else None,
+            'p50_ms': self.percentile(counts, 50),
+            'p90_ms': self.percentile(counts, 90),
+            'p99_ms': self.percentile(counts, 99),
+            'buckets': buckets
+        }
+
+
+class AppenClient:
+    '''
+    Appen API client shared by every thread. Every request waits for the token bucket and a free
+    slot under the adaptive limit, and its latency is recorded under its endpoint. Requests time out after
+    timeout seconds, a requests timeout: seconds or (connect, read), where read bounds every wait for bytes.
+    '''
+
+    def __init__(self, api_url, key, rate, burst, concurrency, max_concurrency, pool_size, verify=True,
+                 backoff_base_s=1, backoff_max_s=30, timeout=(10, 60)):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.api_url = api_url
+        self.key = key
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.errors = requests.exceptions.RequestException
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = AdaptiveLimit(concurrency, 1, max_concurrency)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.timeout = timeout
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, endpoint):
+        with self.lock:
+            if endpoint not in self.histograms:
+                self.histograms[endpoint] = LatencyHistogram()
+            return self.histograms[endpoint]
+
+    def request(self, endpoint, method, url, tries=1, **kwargs):
+        '''
+        Sends a request, trying it up to tries times on connection errors, 429s and 5xxs
+        with exponential backoff and full jitter, or the Retry-After the API asked for
+        :param endpoint: name the request's latency is recorded under
+        :return: the last response, or raises the last connection error or timeout
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(1, tries + 1):
+            self.bucket.take()
+            self.limit.acquire()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except self.errors as e:
+                logger.info(f'Appen {endpoint} request failed: {e}, try {attempt} of {tries}')
+                if attempt == tries:
+                    raise
+            finally:
+                throttled = response is None or response.status_code == 429 or response.status_code >= 500
+                self.limit.release(throttled)
+                self.histogram(endpoint).observe((time.perf_counter() - start) * 1000)
+            if not throttled:
+                return response
+            count('appen_throttled')
+            if attempt == tries:
+                break
+            delay = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+            if response is not None:
+                logger.info(f'Appen {endpoint} answered {response.status_code}, try {attempt} of {tries}')
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            time.sleep(delay)
+        return response
+
+    def job(self, job_id, tries=1):
+        return self.request('job', 'GET', f'{self.api_url}/jobs/{job_id}.json', tries, params={'key': self.key})
+
+    def regenerate(self, job_id, report_type):
+        return self.request('regenerate', 'POST', f'{self.api_url}/jobs/{job_id}/regenerate',
+                            params={'key': self.key, 'type': report_type})
+
+    def report(self, job_id, report_type):
+        return self.request('report', 'GET', f'{self.api_url}/jobs/{job_id}.csv',
+                            params={'key': self.key, 'type': report_type}, stream=True)
+
+    def annotation(self, url, tries=1):
+        return self.request('annotation', 'GET', url, tries)
+
+    def upload(self, job_id, body, headers, tries=1):
+        return self.request('upload', 'POST', f'{self.api_url}/jobs/{job_id}/upload.json', tries,
+                            params={'key': self.key}, headers=headers, data=body)
+
+    def stats(self):
+        '''
+        Returns the current concurrency limit and the latency summary of every endpoint
+        '''
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {'limit': self.limit.limit, 'endpoints': {endpoint: histogram.summary()
+                                                         for endpoint, histogram in histograms.items()}}
@@ -0,0 +1,207 @@
+'''
+Offline end-to-end benchmark of the timer path. Runs the real lambda_handler against a local
+Appen stand-in and an in-process S3 stand-in (see standins.py) loaded with synthetic jobs, then
+reports the stage timers, counters and peak RSS job_handler emits, request counts, hosted objects and peak memory.
+Stage times are summed over threads and jobs, so concurrent stages can add up to more than the total.
+
+    python benchmarks/end_to_end.py --units 1000 --segments 5
+    python benchmarks/end_to_end.py --units 10000 --json run.json
+    python benchmarks/end_to_end.py --units 10000 --baseline run.json   # exits 1 on a regression
+    python benchmarks/end_to_end.py --units 10000 --chunk-rows 2000 --map-mode lambda
+    python benchmarks/end_to_end.py --units 1000 --watermarks file
+'''
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+from collections import defaultdict
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from standins import FakeS3, FakeLambda, AppenStandIn, make_jobs
+
+
+class Context:
+    '''
+    Stands in for the Lambda context, counting down from timeout_s
+    '''
+
+    def __init__(self, timeout_s):
+        self.deadline = time.monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def job_metrics(log):
+    '''
+    Adds up the EMF lines job_handler printed into log, one per job
+    :return: dict of stage -> seconds, dict of counter -> total and dict of stage -> peak RSS in MB
+    '''
+    stages = defaultdict(float)
+    counters = defaultdict(int)
+    peaks = defaultdict(float)
+    for line in log.splitlines():
+        if not line.startswith('{"_aws"'):
+            continue
+        emf = json.loads(line)
+        for definition in emf['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            name = definition['Name']
+            if definition['Unit'] == 'Milliseconds':
+                stages[name[:-len('_ms')]] += emf[name] / 1000
+            elif name.endswith('_peak_rss_bytes'):
+                stage = name[:-len('_peak_rss_bytes')]
+                peaks[stage] = max(peaks[stage], emf[name] / 1024 / 1024)
+            else:
+                counters[name] += emf[name]
+    return dict(stages), dict(counters), dict(peaks)
+
+
+def run(args):
+    os.environ.setdefault('API_KEY', 'benchmark')
+    import lambda_function
+
+    s3 = FakeS3(args.s3_latency_ms / 1000)
+    lambda_function.clients['s3'] = s3
+    sub_invocations = FakeLambda(lambda_function.lambda_handler, args.invoke_latency_ms / 1000)
+    lambda_function.clients['lambda'] = sub_invocations
+    with AppenStandIn(args.api_latency_ms / 1000, args.pending_polls) as api:
+        lambda_function.api_url = f'{api.url}/v1'
+        lambda_function.map_mode = args.map_mode
+        lambda_function.appen_rate = args.appen_rate or lambda_function.appen_rate
+        lambda_function.appen_burst = args.appen_rate or lambda_function.appen_burst
+        lambda_function.map_function = 'benchmark'
+        lambda_function.chunk_rows = args.chunk_rows or lambda_function.chunk_rows
+        lambda_function.map_rows = args.map_rows or lambda_function.map_rows
+        lambda_function.watermark_store = args.watermarks
+        if args.watermarks == 'file':
+            lambda_function.watermark_folder = tempfile.mkdtemp()
+        # pipeline copies its settings from lambda_function when first imported
+        import pipeline
+        pipeline.anno_cache = pipeline.AnnotationCache(lambda_function.anno_cache_items, tempfile.mkdtemp(),
+                                                       lambda_function.anno_cache_bytes)
+        for job in range(args.jobs):
+            make_jobs(s3, api, args.units, args.segments, args.new_fraction, source_job=1000 + job,
+                      qa_job=2000 + job, sample=args.sample)
+            s3.put_object(Bucket=lambda_function.bucket, Key=f'{lambda_function.job_folder}/{1000 + job}')
+        s3.calls.clear()
+        api.calls.clear()
+
+        if args.trace_memory:
+            tracemalloc.start()
+        log = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            lambda_function.lambda_handler({'source': 'aws.events'}, Context(args.timeout_s))
+        total = time.perf_counter() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        tracemalloc.stop()
+
+        hosted = sum(1 for bucket, key in s3.objects if key.startswith('QL1/QA/'))
+        uploaded = sum(max(body.count(b'\n') - 1, 0) for _, body in api.uploads)
+        stages, counters, peaks = job_metrics(log.getvalue())
+        return {
+            'units': args.units, 'segments': args.segments, 'jobs': args.jobs,
+            'total_s': total,
+            'stages': stages,
+            'counters': counters,
+            'stage_peak_rss_mb': peaks,
+            'requests': {**{f'appen {name}': count for name, count in api.calls.items()},
+                         **{f's3 {name}': count for name, count in s3.calls.items()},
+                         **{f'lambda {name}': count for name, count in sub_invocations.calls.items()}},
+            'hosted_objects': hosted,
+            'uploaded_rows': uploaded,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_traced_mb': traced_peak / 1024 / 1024 if traced_peak is not None else None,
+        }
+
+
+def report(result):
+    print(f'{result["jobs"]} job(s) x {result["units"]} units x {result["segments"]} segments')
+    print(f'  {"total":<24} {result["total_s"] * 1000:10.1f} ms')
+    for stage, seconds in result['stages'].items():
+        print(f'  {stage:<24} {seconds * 1000:10.1f} ms')
+    print('counters')
+    for name, value in sorted(result['counters'].items()):
+        print(f'  {name:<24} {value:10d}')
+    print('peak RSS at the end of each stage')
+    for stage, mb in result['stage_peak_rss_mb'].items():
+        print(f'  {stage:<24} {mb:10.1f} MB')
+    print('requests')
+    for name, count in sorted(result['requests'].items()):
+        print(f'  {name:<24} {count:10d}')
+    print(f'hosted objects {result["hosted_objects"]}, uploaded rows {result["uploaded_rows"]}')
+    print(f'peak RSS {result["peak_rss_mb"]:.1f} MB', end='')
+    if result['peak_traced_mb'] is not None:
+        print(f', peak traced {result["peak_traced_mb"]:.1f} MB', end='')
+    print()
+
+
+def regressions(result, baseline, tolerance, slack_s=0.05):
+    '''
+    Lists stages that got slower than baseline by more than tolerance (and slack_s),
+    and request counts that went up
+    '''
+    found = []
+    times = {'total': result['total_s'], **result['stages']}
+    base_times = {'total': baseline['total_s'], **baseline['stages']}
+    for stage, seconds in times.items():
+        base = base_times.get(stage)
+        if base is not None and seconds > base * (1 + tolerance) and seconds - base > slack_s:
+            found.append(f'{stage}: {base * 1000:.1f} ms -> {seconds * 1000:.1f} ms')
+    for name, count in result['requests'].items():
+        base = baseline['requests'].get(name)
+        if base is not None and count > base:
+            found.append(f'{name}: {base} -> {count} requests')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', type=int, default=1000, help='units per source job')
+    parser.add_argument('--segments', type=int, default=5, help='utterances per unit')
+    parser.add_argument('--jobs', type=int, default=1, help='registered source jobs')
+    parser.add_argument('--new-fraction', type=float, default=1.0, help='share of units not yet in the QA job')
+    parser.add_argument('--sample', type=float, default=0.1, help='sample rate in the full report')
+    parser.add_argument('--s3-latency-ms', type=float, default=10, help='latency of every S3 call')
+    parser.add_argument('--api-latency-ms', type=float, default=20, help='latency of every Appen request')
+    parser.add_argument('--pending-polls', type=int, default=0, help='202 answers before a report is ready')
+    parser.add_argument('--appen-rate', type=float,
+                        help='Appen requests per second, lambda_function.appen_rate if not given')
+    parser.add_argument('--map-mode', choices=['inline', 'lambda'], default='inline',
+                        help='run map tasks inline or as (in-process) sub-invocations')
+    parser.add_argument('--chunk-rows', type=int, help='units per uploaded chunk, lambda_function.chunk_rows if not given')
+    parser.add_argument('--map-rows', type=int, help='units per map task, lambda_function.map_rows if not given')
+    parser.add_argument('--watermarks', choices=['s3', 'file'], default='s3',
+                        help='keep watermarks in the S3 stand-in or in a temporary local folder')
+    parser.add_argument('--invoke-latency-ms', type=float, default=30, help='latency of every sub-invocation')
+    parser.add_argument('--timeout-s', type=float, default=15 * 60, help='invocation timeout given to the handler')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the tracemalloc peak (slower)')
+    parser.add_argument('--json', help='write the result to this file')
+    parser.add_argument('--baseline', help='result file to compare against, exits 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
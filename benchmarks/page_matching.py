@@ -0,0 +1,159 @@
+'''
+Benchmark of matching.py on synthetic document pages. Annotator A draws a grid of word boxes,
+annotator B redraws each with some jitter, skips some and adds others, and optionally rotates
+words so they need polygon geometry. Times building the shapes, the IoU and overlap pairs with
+each index and the one to one matching, and checks a sample of pairs against the per pair shapely
+IoU and overlap that calculate_iou and calculate_overlap compute, whose loop over all pairs is
+timed on a slice of the page and scaled up.
+
+    python benchmarks/page_matching.py --elements 5000
+    python benchmarks/page_matching.py --elements 20000 --rotated 0.3 --geometry polygon
+    python benchmarks/page_matching.py --elements 5000 --geometry bbox --json run.json
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+from matching import shapes, overlaps, best_matches, vectorized
+
+
+def word(x, y, width, height, angle=0.0):
+    '''
+    Annotation element of a word box centred on x, y, rotated by angle radians, with its bbox
+    '''
+    corners = np.array([(-width / 2, -height / 2), (width / 2, -height / 2),
+                        (width / 2, height / 2), (-width / 2, height / 2)])
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    points = corners @ rotation.T + (x, y)
+    low, high = points.min(axis=0), points.max(axis=0)
+    return {'class': 'WORD', 'polygon': [{'x': px, 'y': py} for px, py in points.tolist()],
+            'bbox': {'x': low[0], 'y': low[1], 'width': high[0] - low[0], 'height': high[1] - low[1]}}
+
+
+def make_page(elements, rotated=0.0, missed=0.05, jitter=0.15, seed=0):
+    '''
+    Word elements of two annotators on one page of about elements words each
+    '''
+    rng = random.Random(seed)
+    columns = int(np.sqrt(elements * 4))
+    rows = -(-elements // columns)
+    width, height = 0.8 / columns, 0.6 / rows
+    page_a, page_b = [], []
+    for i in range(elements):
+        x, y = (i % columns + 0.5) / columns, (i // columns + 0.5) / rows
+        angle = rng.uniform(-0.3, 0.3) if rng.random() < rotated else 0.0
+        page_a.append(word(x, y, width, height, angle))
+        if rng.random() < missed:
+            continue
+        page_b.append(word(x + rng.gauss(0, jitter * width), y + rng.gauss(0, jitter * height),
+                           width * rng.uniform(0.85, 1.15), height * rng.uniform(0.85, 1.15), angle))
+    for _ in range(int(elements * missed)):
+        page_b.append(word(rng.random(), rng.random(), width, height))
+    return page_a, page_b
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def geometry_of(element, geometry):
+    from shapely.geometry import Polygon, box
+    if geometry == 'polygon':
+        return Polygon([(point['x'], point['y']) for point in element['polygon']])
+    bbox = element['bbox']
+    return box(bbox['x'], bbox['y'], bbox['x'] + bbox['width'], bbox['y'] + bbox['height'])
+
+
+def pairwise(page_a, page_b, geometry):
+    '''
+    IoU and overlap of every pair the way calculate_iou and calculate_overlap do it, one shapely call at a time
+    '''
+    polygons_a = [geometry_of(element, geometry) for element in page_a]
+    polygons_b = [geometry_of(element, geometry) for element in page_b]
+    found = 0
+    for poly_1 in polygons_a:
+        for poly_2 in polygons_b:
+            intersection = poly_1.intersection(poly_2).area
+            if intersection > 0:
+                union = poly_1.union(poly_2).area
+                found += intersection / union > 0 and intersection / poly_1.area > 0
+    return found
+
+
+def check(pairs, page_a, page_b, geometry, sample, seed=0):
+    '''
+    Largest difference between the batch IoU and overlaps and shapely's, over sample pairs
+    '''
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(pairs['a']), min(sample, len(pairs['a'])), replace=False)
+    worst = 0.0
+    for pair in picked:
+        poly_1 = geometry_of(page_a[pairs['a'][pair]], geometry)
+        poly_2 = geometry_of(page_b[pairs['b'][pair]], geometry)
+        intersection = poly_1.intersection(poly_2).area
+        expected = (intersection / poly_1.union(poly_2).area, intersection / poly_1.area, intersection / poly_2.area)
+        found = (pairs['iou'][pair], pairs['overlap_a'][pair], pairs['overlap_b'][pair])
+        worst = max(worst, *(abs(e - f) for e, f in zip(expected, found)))
+    return worst
+
+
+def run(args):
+    page_a, page_b = make_page(args.elements, args.rotated, seed=args.seed)
+    result = {'elements_a': len(page_a), 'elements_b': len(page_b), 'geometry': args.geometry, 'times_s': {}}
+    times = result['times_s']
+    (shapes_a, shapes_b), times['shapes'] = timed(lambda: (shapes(page_a, args.geometry),
+                                                          shapes(page_b, args.geometry)))
+    result['rectangles'] = int(shapes_a.rect.sum() + shapes_b.rect.sum())
+    for index in ['grid', 'strtree'] if vectorized else ['grid']:
+        pairs, times[f'overlaps {index}'] = timed(overlaps, shapes_a, shapes_b, index=index)
+    result['pairs'] = len(pairs['a'])
+    (a, b, iou), times['best_matches'] = timed(best_matches, pairs, args.min_iou)
+    result['matches'] = len(a)
+    result['mean_iou'] = float(iou.mean()) if len(iou) else None
+    if vectorized:
+        result['max_error'] = check(pairs, page_a, page_b, args.geometry, args.check)
+    if args.loop_elements:
+        subset = args.loop_elements
+        _, loop_s = timed(pairwise, page_a[:subset], page_b[:subset], args.geometry)
+        times['pair loop (scaled)'] = loop_s * len(page_a) * len(page_b) / subset ** 2
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', type=int, default=5000, help='words annotator A drew on the page')
+    parser.add_argument('--rotated', type=float, default=0.0, help='share of words drawn rotated')
+    parser.add_argument('--geometry', choices=['polygon', 'bbox'], default='polygon', help='shape compared')
+    parser.add_argument('--min-iou', type=float, default=0.5, help='lowest IoU of a match')
+    parser.add_argument('--check', type=int, default=500, help='pairs checked against shapely')
+    parser.add_argument('--loop-elements', type=int, default=300,
+                        help='words per annotator the pair loop is timed on, 0 to skip it')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the result to this file')
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f'{result["elements_a"]} x {result["elements_b"]} elements, {result["geometry"]}, '
+          f'{result["rectangles"]} axis aligned')
+    for name, seconds in result['times_s'].items():
+        print(f'  {name:<24} {seconds * 1000:10.1f} ms')
+    print(f'{result["pairs"]} intersecting pairs, {result["matches"]} matches, mean IoU {result["mean_iou"]:.3f}')
+    if 'max_error' in result:
+        print(f'largest difference from shapely over checked pairs {result["max_error"]:.2e}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+'''
+Local stand-ins for the services lambda_handler talks to, and synthetic data to serve from them:
+
+    FakeS3 - in-process replacement for the boto3 S3 client, installed into lambda_function.clients
+    FakeLambda - in-process replacement for the boto3 Lambda client, running map tasks through the handler
+    AppenStandIn - local HTTP server answering the Appen jobs, regenerate, .csv and upload.json endpoints
+    make_jobs - synthetic full report, QA source report and annotation JSON of a given size
+'''
+import io
+import re
+import gzip
+import json
+import time
+import random
+import zipfile
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from botocore.exceptions import ClientError
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class FakeS3:
+    '''
+    Thread safe in-memory S3 covering the client calls the Lambda makes.
+    Every call sleeps latency_s to stand in for the network round trip.
+    '''
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def put_object(self, Bucket, Key, Body=b'', IfNoneMatch=None, **kwargs):
+        self.call('put_object')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        etag = f'"{len(Body):x}-{hash(Body) & 0xffffffff:08x}"'
+        with self.lock:
+            if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+                raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': Key}}, 'PutObject')
+            self.objects[(Bucket, Key)] = (Body, etag)
+        return {'ETag': etag, 'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.call('get_object')
+        with self.lock:
+            found = self.objects.get((Bucket, Key))
+        if found is None:
+            raise NoSuchKey({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        body, etag = found
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'ContentLength': len(body),
+                'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.call('delete_objects')
+        with self.lock:
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self.call('list_objects_v2')
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        response = {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)][0])} for key in page],
+                    'KeyCount': len(page), 'IsTruncated': start + MaxKeys < len(keys)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+
+class FakeLambda:
+    '''
+    Lambda client whose invoke runs handler in this process on a JSON round trip of the event,
+    like a synchronous sub-invocation. Every call sleeps latency_s.
+    '''
+
+    def __init__(self, handler, latency_s=0.0):
+        self.handler = handler
+        self.latency_s = latency_s
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, Payload, **kwargs):
+        with self.lock:
+            self.calls['invoke'] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        try:
+            result = self.handler(json.loads(Payload), None)
+        except Exception as e:
+            return {'StatusCode': 200, 'FunctionError': 'Unhandled',
+                    'Payload': io.BytesIO(json.dumps({'errorMessage': str(e)}).encode())}
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(result).encode())}
+
+
+def zip_report(name, df):
+    '''
+    Zips a report DataFrame the way Appen serves it: {name}.zip holding {name}.csv
+    '''
+    body = io.BytesIO()
+    with zipfile.ZipFile(body, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'{name}.csv', df.to_csv(index=False))
+    return body.getvalue()
+
+
+def make_jobs(s3, api, units, segments, new_fraction=1.0, source_job=1000, qa_job=2000, sample=0.1,
+              workers=50, src_bucket='bench-src', seed=0):
+    '''
+    Builds a source job with units units of segments utterances each and its QA job.
+    Originals go to s3, reports and transcriptions are served by api. The QA job source report
+    already holds the oldest units, so only new_fraction of them are new.
+    '''
+    import pandas as pd
+
+    rng = random.Random(seed)
+    start = pd.Timestamp('2021-01-01')
+    rows = []
+    for unit in range(units):
+        ids = [f'u{unit}s{segment}' for segment in range(segments)]
+        original = {'annotation': [{'id': id, 'start': i, 'end': i + 1} for i, id in enumerate(ids)],
+                    'nothingToAnnotate': False}
+        s3.put_object(Bucket=src_bucket, Key=f'audio/{source_job}/{unit}.json', Body=json.dumps(original))
+        api.annotations[f'/annotations/{unit}.json'] = json.dumps({
+            'annotation': [[{'id': id, 'text': 'lorem ipsum ' * rng.randint(1, 8), 'nothingToTranscribe': False}
+                            for id in ids]],
+            'nothingToAnnotate': False, 'ableToAnnotate': True, 'nothingToTranscribe': False}).encode('utf-8')
+        rows.append({'_unit_id': unit, '_created_at': str(start + pd.Timedelta(seconds=unit)),
+                     '_worker_id': rng.randrange(workers), 'tx_work': f'{api.url}/annotations/{unit}.json',
+                     'audio_annotation_url': f's3://{src_bucket}/audio/{source_job}/{unit}.json',
+                     'audio_url': f'https://audio.example/{unit}.wav', 'display_id': unit, 'duration': 1.0,
+                     'pe_file_id': unit, 'pe_file_name': f'{unit}.wav', 'pe_store_id': 'store',
+                     'qa_job': qa_job, 'sample': sample, 'unused_column': 'x' * 64})
+    full = pd.DataFrame(rows)
+    done = units - int(units * new_fraction)
+    source = pd.DataFrame({'orig_created_at': full['_created_at'][:done]})
+    api.reports[(str(source_job), 'full')] = zip_report(f'f{source_job}', full)
+    api.reports[(str(qa_job), 'source')] = zip_report(f'source{qa_job}', source)
+    api.titles[str(source_job)] = f'Benchmark job {source_job}'
+    api.judgments[str(source_job)] = units
+    return full
+
+
+class AppenStandIn:
+    '''
+    Local HTTP server for the Appen endpoints the pipeline calls. Reports answer 202 for the
+    first pending_polls downloads after each regenerate, like a report that is still building.
+    Every request sleeps latency_s.
+    '''
+
+    def __init__(self, latency_s=0.0, pending_polls=0):
+        self.latency_s = latency_s
+        self.pending_polls = pending_polls
+        self.reports = {}
+        self.titles = {}
+        self.judgments = {}
+        self.annotations = {}
+        self.uploads = []
+        self.pending = Counter()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b'', content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                api.serve(self, 'GET')
+
+            def do_POST(self):
+                api.serve(self, 'POST')
+
+        return Handler
+
+    def serve(self, request, method):
+        path, _, query = request.path.partition('?')
+        report_type = re.search(r'type=(\w+)', query)
+        report_type = report_type.group(1) if report_type else None
+        body = request.rfile.read(int(request.headers.get('Content-Length') or 0)) if method == 'POST' else b''
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        if path.startswith('/annotations/'):
+            self.count('annotation')
+            annotation = self.annotations.get(path)
+            return request.reply(200, annotation) if annotation else request.reply(404, b'{}')
+        match = re.fullmatch(r'/v1/jobs/(\w+)(/regenerate|/upload\.json|\.csv|\.json)', path)
+        if match is None:
+            return request.reply(404, b'{}')
+        job_id, endpoint = match.groups()
+        self.count(endpoint.strip('/.'))
+        if endpoint == '/regenerate':
+            with self.lock:
+                self.pending[(job_id, report_type)] = self.pending_polls
+            return request.reply(200, b'{}')
+        if endpoint == '.csv':
+            with self.lock:
+                pending = self.pending[(job_id, report_type)]
+                self.pending[(job_id, report_type)] = max(pending - 1, 0)
+            if pending:
+                return request.reply(202, b'{}')
+            report = self.reports.get((job_id, report_type))
+            return request.reply(200, report, 'application/zip') if report else request.reply(404, b'{}')
+        if endpoint == '.json':
+            return request.reply(200, json.dumps({'id': job_id, 'title': self.titles.get(job_id, ''),
+                                                  'judgments_count': self.judgments.get(job_id, 0)}).encode())
+        with self.lock:
+            self.uploads.append((job_id, body))
+        rows = max(body.count(b'\n') - 1, 0)
+        return request.reply(200, json.dumps({'success': {'message': f'{rows} rows uploaded'}}).encode())
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
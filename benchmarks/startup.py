@@ -0,0 +1,67 @@
+'''
+Measures the cold start of each lambda_handler path. Every run is a fresh interpreter,
+so module imports and client creation are timed as a new Lambda container would pay them.
+
+    python benchmarks/startup.py --runs 5
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; argv[1] is the path to time
+child = '''
+import sys, time, json
+timings = {}
+start = time.perf_counter()
+import lambda_function
+timings['import lambda_function'] = time.perf_counter() - start
+if sys.argv[1] == 'timer':
+    start = time.perf_counter()
+    import pipeline
+    timings['import pipeline'] = time.perf_counter() - start
+start = time.perf_counter()
+lambda_function.get_s3_client()
+timings['init s3 client'] = time.perf_counter() - start
+if sys.argv[1] == 'timer':
+    start = time.perf_counter()
+    lambda_function.get_appen()
+    timings['init appen client'] = time.perf_counter() - start
+timings['pandas imported'] = 'pandas' in sys.modules
+print(json.dumps(timings))
+'''
+
+def run(path):
+    '''
+    Times one cold start of path ('webhook' or 'timer') in a new interpreter
+    '''
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('API_KEY', 'startup')
+    result = subprocess.run([sys.executable, '-c', child, path], cwd=repo, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='cold starts per path, the median is reported')
+    args = parser.parse_args()
+    for path in ('webhook', 'timer'):
+        runs = [run(path) for _ in range(args.runs)]
+        print(f'{path} path ({args.runs} cold starts, median)')
+        total = 0.0
+        for stage in runs[0]:
+            if stage == 'pandas imported':
+                continue
+            ms = statistics.median(timings[stage] for timings in runs) * 1000
+            total += ms
+            print(f'  {stage:<24} {ms:8.1f} ms')
+        print(f'  {"total":<24} {total:8.1f} ms')
+        print(f'  pandas imported: {runs[0]["pandas imported"]}')
+
+if __name__ == '__main__':
+    main()
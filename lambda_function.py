@@ -1,37 +1,123 @@
 import os
-import copy
-import datetime
-import requests
-import time
-import logging
-import zipfile
 import json
-import pandas as pd
-import boto3
+import time
 import base64
+import logging
+import threading
 from urllib.parse import unquote
-import io
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import debug, reset_peak_rss
+from transfer import list_objects, get_object, put_object, put_objects
+
+# pandas, requests and the report pipeline are only imported on the timer path, and boto3
+# only once S3 is first used, so a cold webhook never loads the report pipeline.
 
 
 # Internal settings: 
 
 max_tries = 200  # Controls how many time reports are regenerated and redownloaded before erroring
+poll_base_s = 1  # First backoff delay between report polls, doubled on every try
+poll_max_s = 30  # Longest backoff delay between report polls
+report_deadline_s = 10 * 60  # Controls how long a single report may take to regenerate and download
+report_chunksize = 10000  # Controls how many report rows are parsed at a time
+chunk_rows = 250  # Controls how many new units are fetched, sampled and uploaded at a time
+job_row_budget = 5000  # Controls how many new units of one source job are processed per invocation
+chunk_reserve_ms = 2 * 60 * 1000  # Stops starting new chunks once less than this much invocation time is left
+upload_chunk_bytes = 4 * 1024 * 1024  # Controls how large a single upload request to the QA job may get
+upload_tries = 5  # Controls how many times a failed upload request is sent before erroring
+upload_gzip = False  # Gzips upload requests (Content-Encoding: gzip)
+fetch_workers = 16  # Controls how many annotations are fetched at once
+host_workers = 16  # Controls how many utterances are hosted to S3 at once
+s3_max_attempts = 5  # Controls how many times a failed S3 call is tried before erroring
+anno_cache_items = 2048  # Controls how many annotations are kept in memory between invocations on a warm container
+anno_cache_bytes = 256 * 1024 * 1024  # Controls how much of /tmp the annotation cache may use
+anno_cache_folder = '/tmp/anno_cache'  # Folder the annotation cache spills to
+job_workers = 4  # Controls how many source jobs are processed at once on a timer tick
+job_reserve_ms = 5 * 60 * 1000  # Stops starting new source jobs once less than this much invocation time is left
+reconcile_s = 24 * 60 * 60  # Controls how often a stored watermark is checked against the QA job source report
+registry_ttl_s = 5 * 60  # Controls how long a warm container reuses its listing of the registered source jobs
+job_info_ttl_s = 60 * 60  # Controls how long a source job title noted in the registry is used before rereading it
+map_mode = 'inline'  # Where map tasks run: 'inline', 'processes' (local pool) or 'lambda' (sub-invocations)
+map_rows = 250  # Controls how many unit rows, or sampled utterances, one map task takes
+map_workers = 8  # Controls how many map tasks run at once in 'processes' and 'lambda' mode
+map_function = None  # Lambda function map tasks are sent to in 'lambda' mode, this function when None
+map_payload_bytes = 5 * 1024 * 1024  # Map task frames larger than this pass through S3, as invoke payloads are capped at 6 MB
+unit_tries = 3  # Controls how many runs a unit that fails to fetch or host is tried on before it is dead-lettered
+unit_retry_s = 24 * 60 * 60  # Dead-letters a failing unit this long after its first failure, however few runs it had
+
+api_url = 'https://api.appen.com/v1'  # Appen API that reports are regenerated, downloaded and uploaded through
+appen_rate = 100  # Controls how many Appen requests are sent per second on average
+appen_burst = 100  # Controls how many Appen requests may be sent at once after a quiet spell
+appen_concurrency = 16  # Appen requests in flight to start with, halved on every 429 or 5xx and regrown one at a time
+appen_max_concurrency = 64  # Most Appen requests in flight
+appen_tries = 3  # Controls how many times a throttled annotation fetch or job read is sent
+appen_verify_tls = True  # Verifies the TLS certificates of Appen hosts
+appen_timeout_s = (10, 60)  # Connect and read timeouts of every Appen request, so a hung one fails instead of blocking its thread
 
 # PATH: S3://{bucket}/{folder}/utterance_transcribed/example.json
 bucket = 'bucket'  # Bucket that utterances get hosted to
 
 # PATH S3://{bucket}/{path}/
 job_folder = 'source_jobs/dev' # Folder in bucket to store source job_ids 
+registry_key = 'source_jobs/registry/dev.json' # Metadata of every source job (last run, QA job), see JobRegistry
+watermark_folder = 'watermarks/dev' # Folder in bucket to store the last processed timestamp of each source job
+watermark_store = 's3' # Where watermarks are kept: 's3' (watermark_folder in bucket) or 'file' (local watermark_folder, for testing)
+queue_folder = 'queue/dev' # Folder in bucket units sent by unit_complete webhooks wait in for the timer
+map_folder = 'map/dev' # Folder in bucket map task frames too large for an invoke payload pass through
+dead_letter_folder = 'dead_letter/dev' # Folder in bucket units given up on after unit_tries runs are written to
 results_header = 'tx_work' # annotation results header from origin job
+# Columns of the origin job full report used by job_handler, the rest are never parsed
+full_report_columns = ['_unit_id', '_created_at', '_worker_id', results_header, 'audio_annotation_url', 'audio_url',
+                       'display_id', 'duration', 'pe_file_id', 'pe_file_name', 'pe_store_id']
+# Columns of the full report repeated across many units, held as categoricals
+category_columns = ['_worker_id', 'pe_store_id']
 
 
 # Initializes logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initializes S3 Success Access
-s3_client = boto3.client('s3')
-s3 = boto3.resource('s3')  
+# Shared S3 and HTTP clients, created on first use
+clients = {}
+clients_lock = threading.Lock()
+
+def get_s3_client():
+    '''
+    Returns the S3 client shared by every thread, creating it on first use
+    '''
+    with clients_lock:
+        if 's3' not in clients:
+            import boto3
+            from botocore.config import Config
+            clients['s3'] = boto3.client('s3', config=Config(max_pool_connections=max(fetch_workers, host_workers),
+                                                             retries={'max_attempts': s3_max_attempts, 'mode': 'standard'}))
+        return clients['s3']
+
+def get_appen():
+    '''
+    Returns the Appen API client shared by every thread, creating it on first use
+    '''
+    with clients_lock:
+        if 'appen' not in clients:
+            from appen import AppenClient
+            clients['appen'] = AppenClient(api_url, os.environ['API_KEY'], appen_rate, appen_burst, appen_concurrency,
+                                           appen_max_concurrency, max(fetch_workers, appen_max_concurrency),
+                                           appen_verify_tls, poll_base_s, poll_max_s, appen_timeout_s)
+        return clients['appen']
+
+def get_lambda_client():
+    '''
+    Returns the Lambda client map tasks are sent through, creating it on first use
+    '''
+    with clients_lock:
+        if 'lambda' not in clients:
+            import boto3
+            from botocore.config import Config
+            # A sub-invocation can run for as long as this one
+            clients['lambda'] = boto3.client('lambda', config=Config(max_pool_connections=map_workers,
+                                                                     read_timeout=15 * 60))
+        return clients['lambda']
 
 def parse_event(event: str) -> dict:
     '''
@@ -42,6 +128,8 @@ def parse_event(event: str) -> dict:
     '''
     if 'source' in event:
         return {'signal':'timer'}
+    if 'invalidate' in event:
+        return {'signal': 'invalidate', 'payload': event['invalidate']}
     event_body = base64.b64decode(event['body']).decode('utf-8')
     signal = event_body.split('&')[0].replace("signal=", "")
     payload = json.loads(unquote(event_body.split('&')[1].replace("payload=", "")))
@@ -53,295 +141,200 @@ def parse_event(event: str) -> dict:
         'signature': signature
     }
     
-def get_job_title(job_id,params):
-    response = requests.get(
-        f'https://api.appen.com/v1/jobs/{job_id}.json', params=params)
-    if response.status_code != 200:
-        print(
-            f'---- Status code: {response.status_code} \n {response.text}')
-    else:
-        print('---- Success!')
-        read_response = json.loads(response.text)
-        return (read_response['title'])
-
-def get_anno_path(s3_path):
-    print(s3_path)
-    bucket = s3_path.split('/')[2]
-    filepath = "/".join(s3_path.split('/')[3:])
-    try:
-        obj = s3_client.get_object(Bucket=bucket, Key=filepath)
-    except:
-        return False
-    s3_clientdata = obj['Body'].read().decode('utf-8')
-    return s3_clientdata
-    
-def get_anno_url_old(anno_url):
-    response = requests.get(anno_url, verify=False)
-    anno_transcribed = response.json()
-    return anno_transcribed
-    
-def get_anno_url(obj):
-    if '{' in obj:
-        print(obj)
-        json_obj = json.loads(obj)
-        print(json_obj)
-        url = json_obj['url']
-        print(url)
-        anno_url = url.replace('requestor-proxy.appen.com','api-beta.appen.com') + f"&key={os.environ['API_KEY']}"
-    else:
-        anno_url = obj
-    response = requests.get(anno_url, verify=False)
-    anno_transcribed = response.json()
-    return anno_transcribed
-
-def get_utts(row,row_list):
+class JobRegistry:
     '''
-    Extracts utterances from annotation
+    Source jobs registered by the webhook, one empty marker object per job under {folder}/,
+    and an index object at index_key with the metadata of every job (last run, QA job, backlog)
+    so the timer can order jobs with a single read
     '''
-    worker = row['_worker_id']
-    if not row['anno0']:
-        return 
-    anno0 = json.loads(row['anno0'])
-    anno1 = row['anno1']
-    audio_annotation_url = row['audio_annotation_url']
-    audio_url = row['audio_url']
-    unit_id = row['_unit_id']
-    created_at = row['_created_at']
-    if anno1['nothingToTranscribe'] or not len(anno1['annotation']):
-        return
-    print('annotation', anno1['annotation'])
-    for utt1 in anno1['annotation'][0]:
-        if utt1['nothingToTranscribe']:
-            continue
-        sample1 = {'annotation':[[utt1]],"nothingToAnnotate": False, "ableToAnnotate": True, "nothingToTranscribe": False }
-        for utt0 in anno0['annotation']:
-            if utt0['id'] == utt1['id']:
-                sample0 = {'annotation':[[utt0]],"nothingToAnnotate": False }
-        row_dict = {'sample0':sample0,
-                    'sample1':sample1,
-                    'orig_worker_id':worker,
-                    'audio_annotation_url':audio_annotation_url,
-                    'audio_url':audio_url,
-                    'orig_unit_id':unit_id,
-                    'orig_created_at' : created_at,
-                    'display_id':row['display_id'],
-                    'duration':row['duration'],
-                    'pe_file_id':row['pe_file_id'],
-                    'pe_file_name':row['pe_file_name'],
-                    'pe_store_id':row['pe_store_id']
-        }
-        row_list.append(row_dict)
 
-def host_utts(row, bucket, job_id):
-    '''
-    Hosts utterances to s3 bucket
-    '''
-    print('bucket',bucket)
-    print('job_id',job_id)
-    audio_annotation_url = row['audio_annotation_url']
-    print(audio_annotation_url)
-    folder = "/".join(audio_annotation_url.split('/')[3:-1])
-    filename = audio_annotation_url.split('/')[-1].replace('.json','')
-    sample0 = row['sample0']
-    sample1 = row['sample1']
-    audio_url = row['audio_url']
-    worker = row['orig_worker_id']
-    unit_id = row['orig_unit_id']
-    sample_id = sample0['annotation'][0][0]['id']
-    utterance = f'QL1/QA/{job_id}/utterance/{folder}/{filename}_{sample_id}.json'
-    utterance_transcribed = f'QL1/QA/{job_id}/utterance_transcribed/{folder}/{filename}_{sample_id}_{worker}.json'
-    s3.Object(bucket, utterance).put(Body=json.dumps(sample0))
-    s3.Object(bucket, utterance_transcribed).put(Body=json.dumps(sample1))
-    utterance_path = f's3://{bucket}/{utterance}'
-    utterance_transcribed_path = f's3://{bucket}/{utterance_transcribed}'
-    row_dict = {'utterance': utterance_path, 'utterance_transcribed': utterance_transcribed_path}
-    return pd.Series(row_dict)
+    def __init__(self, bucket, folder, index_key, ttl_s=registry_ttl_s):
+        self.bucket = bucket
+        self.folder = folder
+        self.index_key = index_key
+        self.ttl_s = ttl_s
+        self.known = set()
+        self.listed_at = None
+        self.notes = {}
+        self.lock = threading.Lock()
 
-# sample utterances with a minimum of 1/contributor
-def sample(chunk, rate):
-    n = max(int(len(chunk)*rate), 1)
-    return chunk.sample(n=n, replace=True, random_state=1)
+    def register(self, job_id):
+        '''
+        Adds job_id with one conditional put, or none if this container already registered it
+        :return: True if job_id was not registered before
+        '''
+        if job_id in self.known:
+            return False
+        # 'exists' also covers a 409 from another webhook registering the same job right now
+        if put_object(get_s3_client(), self.bucket, f'{self.folder}/{job_id}', b'', IfNoneMatch='*')['status'] == 'exists':
+            debug('Source job %s is already registered', job_id)
+            new = False
+        else:
+            print(f'Added {job_id} as a source job!')
+            new = True
+        with self.lock:
+            self.known.add(job_id)
+        return new
 
+    def job_ids(self):
+        '''
+        Lists the registered source job_ids page by page, reusing the last listing for ttl_s
+        '''
+        with self.lock:
+            if self.listed_at is not None and time.monotonic() - self.listed_at < self.ttl_s:
+                return sorted(self.known)
+        jobs = set()
+        for obj in list_objects(get_s3_client(), self.bucket, self.folder + '/'):
+            debug('Found object %s', obj)
+            jobs.add(obj['Key'].split('/')[-1].split('.')[0])
+        with self.lock:
+            self.known = jobs
+            self.listed_at = time.monotonic()
+        return sorted(jobs)
 
-def put_job_id(job_id,bucket,job_folder):
-    s3.Object(bucket, job_folder + '/' + job_id).put(Body='')
-    response = s3_client.list_objects_v2(
-        Bucket=bucket,
-        Prefix=job_folder)
-    for obj in response.get('Contents', []):
-        print('Found object', obj)
-        if obj['Key'] == job_folder + '/' + job_id:
-            return False
-    print(f'Added {job_id} as a source job!')
-    return True
-    
-def get_job_ids(bucket,job_folder):
-    jobs = []
-    response = s3_client.list_objects_v2(
-        Bucket=bucket,
-        Prefix=job_folder)
-    for obj in response.get('Contents', []):
-        print(obj)
-        jobs.append(obj['Key'].split('/')[-1].split('.')[0])
-        print(jobs)
-    return jobs
-        
+    def metadata(self):
+        '''
+        Reads the index
+        :return: dict of job_id -> dict of metadata
+        '''
+        result = get_object(get_s3_client(), self.bucket, self.index_key)
+        if result['status'] == 'missing':
+            return {}
+        return json.loads(result['body'])
+
+    def note(self, job_id, **fields):
+        '''
+        Records metadata of job_id, written to the index on the next save
+        '''
+        with self.lock:
+            self.notes.setdefault(str(job_id), {}).update(fields)
 
+    def save(self):
+        '''
+        Writes the noted metadata into the index
+        '''
+        with self.lock:
+            notes, self.notes = self.notes, {}
+        if not notes:
+            return
+        index = self.metadata()
+        for job_id, fields in notes.items():
+            index.setdefault(job_id, {}).update(fields)
+        put_object(get_s3_client(), self.bucket, self.index_key, json.dumps(index))
 
-def regenerate_report(job_id, params, max_tries):
+registry = JobRegistry(bucket, job_folder, registry_key)
+
+def queue_units(job_id, units, bucket, queue_folder):
     '''
-    Takes in a job ID, param {'key': my_api_key, 'type': reporttype}, and max_tries
+    Saves the units of a unit_complete payload as full report rows for the timer to sample,
+    one object per unit so a retried webhook overwrites its units instead of repeating them.
+    Units whose data has no qa_job or sample are left to the full report.
+    :return: number of units queued
     '''
-    counter = 0
-    while counter < max_tries:
-        response = requests.post(f'https://api.appen.com/v1/jobs/{job_id}/regenerate', params=params)
-        counter += 1
-        print(f'-- Response: {response.status_code} -- {str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))} -- Count:{counter}')
-        if response.status_code == 200:
-            print(f'Regenerated {job_id} {params[1][1]} report!')
-            break
-        time.sleep(1)
-    return True
+    rows = []
+    for unit in units:
+        judgments = unit.get('results', {}).get('judgments')
+        if not judgments:
+            continue
+        judgment = judgments[-1]
+        result = judgment['data'].get(results_header)
+        row = {'_unit_id': unit['id'], '_created_at': judgment['created_at'], '_worker_id': judgment['worker_id'],
+               results_header: result if isinstance(result, str) else json.dumps(result)}
+        for column in full_report_columns + ['qa_job', 'sample']:
+            if column not in row:
+                row[column] = unit['data'].get(column)
+        try:
+            int(row['qa_job'])
+            float(row['sample'])
+        except (TypeError, ValueError):
+            # The timer samples the unit from the full report instead
+            logger.info(f'Unit {unit["id"]} of {job_id} has no valid qa_job or sample, not queueing it')
+            continue
+        rows.append((f'{queue_folder}/{job_id}/{unit["id"]}.json', json.dumps(row)))
+    errors = [result['status'] for result in put_objects(get_s3_client(), bucket, rows, host_workers)
+              if result['status'] != 'success']
+    if errors:
+        raise errors[0]
+    return len(rows)
 
-def get_report(job_id, params, max_tries):
+def order_jobs(jobs, metadata):
     '''
-    Takes in a job ID, param {'key': my_api_key, 'type': reporttype}, and max_tries
+    Puts the source jobs that have gone longest without running first, new jobs before all others,
+    so jobs skipped on the last tick run first on the next
     '''
-    counter = 0
-    while counter < max_tries:
-        response = requests.get(f'https://api.appen.com/v1/jobs/{job_id}.csv', params=params)
-        counter += 1
-        print(f'-- Response: {response.status_code} -- {str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))} -- Count:{counter}')
-        if response.status_code == 200:
-            print(f'Download complete for job {job_id}, Saving {params[1][1]} report')
-            break
-        time.sleep(1)
-    if params[1][1] == 'full':
-        fname = f'f{job_id}'
-    elif params[1][1] == 'source':
-        fname = f'source{job_id}'
-    output = open(f'/tmp/{fname}.zip', 'wb')
-    output.write(response.content)
-    output.close()
-    print(f'-- Extracting {fname}.zip')
-    try:
-        zf = zipfile.ZipFile(f'/tmp/{fname}.zip')
-        print('UNZIP REPORT')
-    except:
-        print('UNABLE TO UNZIP')
-    df = pd.read_csv(zf.open(f'{fname}.csv'))
-    print(f'reading the {params[1][1]} report')
-    return df
+    return sorted(jobs, key=lambda job: metadata.get(job, {}).get('last_run') or 0)
 
-def upload_report(df, job_id):
+def run_jobs(jobs, context, metadata=None, workers=job_workers, reserve_ms=job_reserve_ms):
     '''
-    Takes in a DataFrame and job ID
+    Runs job_handler over jobs with at most workers running at once, passing each its registry metadata.
+    No new job is started once the invocation has less than reserve_ms left.
+    :return: dict of job_id -> job status and list of job_ids that were never started
     '''
-    df.to_csv('/tmp/qa_src.csv', index=False)
-    with open('/tmp/qa_src.csv') as csvfile:
-        source = csvfile.read()
-    headers = {"Content-Type": "text/csv"}
-    req = f"https://api.appen.com/v1/jobs/{job_id}/upload.json?key={os.environ['API_KEY']}"
-    res = requests.post(req, headers=headers,  data=source)
-    return res
-    
-def job_handler(job_1):
-   
-    params_1 = (
-    ('key', os.environ['API_KEY']),
-    ('type', 'full'),
-    )
-    regenerate_report(job_1,params_1,max_tries)
-    df1 = get_report(job_1,params_1,max_tries)
-    
-    if len(df1) == 0:
-        logger.info(f'No rows in origin job {job_1}!')
-        return False
-    max_i = len(df1)-1
-    try:
-        job_2 = df1['qa_job'][max_i]
-    except Exception as e:
-        logger.info(f'Could not get QA Job ID from {job_1}!')
-        logger.info(e)
-        return False
-    try:
-        sample_pct = df1['sample'][max_i]
-    except Exception as e:
-        logger.info(f'Could not get sample rate from {job_1}!')
-        logger.info(e)
-        return False
-    
-    params_2 = (
-    ('key', os.environ['API_KEY']),
-    ('type', 'source'),
-    )
-    regenerate_report(job_2,params_2,max_tries)
-    df2 = get_report(job_2,params_2,max_tries)
-    
-    if len(df2) != 0:
-        timestamp = pd.to_datetime(df2['orig_created_at']).max()
-        logger.info(f'most recent timestamp in QA job: {str(timestamp)}')
-        df1['_created_at_dt'] = pd.to_datetime(df1['_created_at'])
-        df1 = df1[df1['_created_at_dt'] > timestamp]
-        df1.sort_values(by='_created_at_dt')
-        df1 = df1.head(250)
-        if len(df1) == 0:
-            logger.info('No new rows to sample!')
-            return True
-    else:
-        logger.info(f'No rows in QA Job {job_2}! ')
-    
-    df1['anno1'] = df1[results_header].apply(get_anno_url)
-    
-    # filter out rows with no audio_transcription
-    df1 = df1[df1['anno1']!={'annotation': [], 'nothingToAnnotate': False, 'ableToAnnotate': False, 'nothingToTranscribe': True}]
-    
-    df1['anno0'] = df1['audio_annotation_url'].apply(get_anno_path)
-    
-    row_list = []
-    df1.apply(lambda x: get_utts(x,row_list),axis=1)
-    df = pd.DataFrame(row_list)
-    if len(df) == 0:
-        print('All new utterances were marked as "Nothing to Annotate"')
-        return True
-    # Divided by 2 since it was oversampling
-    df = df.groupby('orig_worker_id').apply(lambda x: sample(x, sample_pct))
-    # df = df.apply(lambda x: x.sample(frac=sample_pct))
-    df[['utterance', 'utterance_transcribed']] = df.apply(lambda x: host_utts(x, bucket, job_1), axis=1)
-    df['orig_job_id'] = job_1
-    print(df.columns)
-    df = df.drop(columns=['sample0','sample1']) 
-    params = {'key': os.environ['API_KEY']}
-    df['from_job_name'] = get_job_title(job_1,params)
-    
-    df_len = len(df)
-    print(f'Uploading {df_len} rows to {job_2}')
-    res = upload_report(df, job_2)
-    logger.info(res)
-    
-    return True
-    
-    
+    from pipeline import job_handler
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+    pending = list(jobs)
+    skipped = []
+    running = {}
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while pending and len(running) < workers:
+                if context.get_remaining_time_in_millis() < reserve_ms:
+                    logger.info(f'Out of time, carrying over {len(pending)} jobs to the next tick')
+                    skipped, pending = pending, []
+                    break
+                job = pending.pop(0)
+                running[executor.submit(job_handler, job, deadline, (metadata or {}).get(job))] = job
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    statuses[job] = future.result()
+                except Exception as e:
+                    logger.info(f'Job {job} raised: {e}')
+                    statuses[job] = False
+    return statuses, skipped
+        
+
+
 def lambda_handler(event, context):
     
+    if 'map' in event:
+        # Sub-invocation running one map task of a timer invocation, see pipeline.run_map
+        from pipeline import run_task_json
+        return run_task_json(event)
     print(event)
     event = parse_event(event)
     print(event)
     if event['signal'] == 'timer':
+        reset_peak_rss()
         # Get origin job IDs
-        jobs = get_job_ids(bucket,job_folder)
-        print(jobs[0],jobs)
-        for job in jobs:
-            print(job)
-            job_status = job_handler(job)
+        metadata = registry.metadata()
+        jobs = order_jobs(registry.job_ids(), metadata)
+        print(jobs)
+        started = time.time()
+        statuses, _ = run_jobs(jobs, context, metadata)
+        for job, job_status in statuses.items():
+            registry.note(job, last_run=started, last_status=bool(job_status))
             if not job_status:
                 print(f'Something went wrong with {job}!')
+        registry.save()
+        if 'appen' in clients:
+            # Latencies are counted since the container started
+            logger.info(f'Appen API: {json.dumps(clients["appen"].stats())}')
+        return {'statusCode': 200}
+    elif event['signal'] == 'invalidate':
+        # Invoked by hand with {"invalidate": [job_id, ...]} after changing a job's title, QA job or sample rate
+        for job_id in event['payload']:
+            registry.note(job_id, title=None, info_at=None, qa_job=None, sample=None, judgments=None)
+        registry.save()
         return {'statusCode': 200}
     else:
-        try:
-            job_id = str(event['payload']['job_id'])
-        except:
-            job_id = str(event['payload'][0]['job_id'])
-        put_job_id(job_id,bucket,job_folder)
+        units = event['payload'] if isinstance(event['payload'], list) else [event['payload']]
+        job_id = str(units[0]['job_id'])
+        registry.register(job_id)
+        if event['signal'] == 'unit_complete':
+            print(f'Queued {queue_units(job_id, units, bucket, queue_folder)} units of {job_id}')
         return {'statusCode': 200}
-    
\ No newline at end of file
@@ -0,0 +1,255 @@
+import numpy as np
+
+try:
+    import shapely
+    vectorized = int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+    shapely = None
+    vectorized = False
+
+# Batch IoU and overlap between two sets of annotation elements, e.g. the word boxes of two annotators,
+# and one to one best matches between them. Candidate pairs come from a spatial index on the element
+# bounds (an STRtree, or a uniform grid without shapely 2), so only boxes that touch are compared.
+# Pairs of axis aligned rectangles, which includes every bbox element, are computed from their bounds
+# in NumPy. Only pairs with a rotated or irregular polygon go through shapely, in one vectorized call.
+
+
+class Shapes:
+    '''
+    Bounds (minx, miny, maxx, maxy), areas and rectangle flags of a set of elements. Polygon
+    points are kept flat with the element each belongs to, and turned into shapely geometries
+    only for the non rectangular elements a comparison needs.
+    '''
+
+    def __init__(self, bounds, areas, rect, points=None, owners=None, geometries=None):
+        self.bounds = bounds
+        self.areas = areas
+        self.rect = rect
+        self.points = points
+        self.owners = owners
+        self.geometries = geometries
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def geometry(self, indices):
+        '''
+        Returns valid shapely geometries of the elements at indices, in the same order
+        '''
+        if self.geometries is not None:
+            geometries = self.geometries[indices]
+        else:
+            unique, inverse = np.unique(indices, return_inverse=True)
+            keep = np.isin(self.owners, unique)
+            # Elements given as bboxes have no points and stay boxes
+            owners, ring = np.unique(self.owners[keep], return_inverse=True)
+            polygons = shapely.box(*self.bounds[unique].T)
+            polygons[np.searchsorted(unique, owners)] = shapely.polygons(
+                shapely.linearrings(self.points[keep], indices=ring))
+            geometries = polygons[inverse]
+        invalid = ~shapely.is_valid(geometries)
+        if invalid.any():
+            geometries = geometries.copy()
+            geometries[invalid] = shapely.make_valid(geometries[invalid])
+        return geometries
+
+
+def shapes(elements, geometry='polygon'):
+    '''
+    Reads the shapes of elements, which may be annotation elements with a 'polygon' (list of points
+    with x and y) and/or a 'bbox' (x, y, width and height), shapely geometries, an (n, 4) array
+    of bounds or a Shapes.
+    :param geometry: 'polygon' to use an element's polygon when it has one and its bbox otherwise,
+    'bbox' to always use the bbox
+    :return: Shapes
+    '''
+    if isinstance(elements, Shapes):
+        return elements
+    if isinstance(elements, np.ndarray) and elements.ndim == 2 and elements.shape[1] == 4:
+        bounds = elements.astype(np.float64)
+        areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+        return Shapes(bounds, areas, np.ones(len(bounds), bool))
+    elements = list(elements)
+    if elements and not isinstance(elements[0], dict):
+        geometries = np.asarray(elements, dtype=object)
+        bounds = shapely.bounds(geometries)
+        areas = shapely.area(geometries)
+        box_areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+        return Shapes(bounds, areas, np.isclose(areas, box_areas, rtol=1e-9, atol=0), geometries=geometries)
+
+    bounds = np.zeros((len(elements), 4))
+    points = []
+    owners = []
+    for i, element in enumerate(elements):
+        polygon = element.get('polygon') if geometry == 'polygon' else None
+        if polygon:
+            points.extend((point['x'], point['y']) for point in polygon)
+            owners.extend([i] * len(polygon))
+        else:
+            box = element['bbox']
+            bounds[i] = (box['x'], box['y'], box['x'] + box['width'], box['y'] + box['height'])
+    points = np.array(points, dtype=np.float64).reshape(-1, 2)
+    owners = np.array(owners, dtype=np.int64)
+    areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    rect = np.ones(len(elements), bool)
+    if len(points):
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        polygons = owners[starts]
+        bounds[polygons, :2] = np.minimum.reduceat(points, starts)
+        bounds[polygons, 2:] = np.maximum.reduceat(points, starts)
+        # Shoelace area, each point paired with the next one of its polygon
+        following = np.arange(1, len(points) + 1)
+        following[np.r_[starts[1:], len(points)] - 1] = starts
+        cross = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+        shoelace = np.abs(np.add.reduceat(cross, starts)) / 2
+        box_areas = (bounds[polygons, 2] - bounds[polygons, 0]) * (bounds[polygons, 3] - bounds[polygons, 1])
+        # A polygon as large as its bounds is an axis aligned rectangle. Self intersecting ones never are,
+        # and get their area from shapely after make_valid.
+        rect[polygons] = np.isclose(shoelace, box_areas, rtol=1e-9, atol=0)
+        areas[polygons] = shoelace
+        result = Shapes(bounds, areas, rect, points, owners)
+        sizes = np.diff(np.r_[starts, len(points)])
+        irregular = polygons[~rect[polygons] & (sizes >= 3)]
+        if len(irregular):
+            areas[irregular] = shapely.area(result.geometry(irregular))
+        return result
+    return Shapes(bounds, areas, rect, points, owners)
+
+
+def grid_candidates(bounds_a, bounds_b, cell=None):
+    '''
+    Pairs of elements whose bounds intersect, found through a uniform grid of cell sized squares
+    :param cell: grid cell size, the median element extent if None
+    :return: arrays of indices into a and into b
+    '''
+    if not len(bounds_a) or not len(bounds_b):
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    both = np.concatenate([bounds_a, bounds_b])
+    if cell is None:
+        extents = np.maximum(both[:, 2] - both[:, 0], both[:, 3] - both[:, 1])
+        cell = np.median(extents[extents > 0]) if (extents > 0).any() else 1.0
+    origin = both[:, :2].min(axis=0)
+    columns = int((both[:, 2].max() - origin[0]) // cell) + 1
+
+    def covered(bounds):
+        # Every (cell key, element) pair of the cells each element's bounds cover
+        low = ((bounds[:, :2] - origin) // cell).astype(np.int64)
+        high = ((bounds[:, 2:] - origin) // cell).astype(np.int64)
+        width = high[:, 0] - low[:, 0] + 1
+        per_element = width * (high[:, 1] - low[:, 1] + 1)
+        element = np.repeat(np.arange(len(bounds)), per_element)
+        k = np.arange(per_element.sum()) - np.repeat(np.cumsum(per_element) - per_element, per_element)
+        x = low[element, 0] + k % width[element]
+        y = low[element, 1] + k // width[element]
+        return y * columns + x, element
+
+    keys_a, elements_a = covered(bounds_a)
+    keys_b, elements_b = covered(bounds_b)
+    order = np.argsort(keys_b, kind='stable')
+    keys_b, elements_b = keys_b[order], elements_b[order]
+    start = np.searchsorted(keys_b, keys_a, 'left')
+    hits = np.searchsorted(keys_b, keys_a, 'right') - start
+    a = np.repeat(elements_a, hits)
+    b = elements_b[np.repeat(start, hits) + np.arange(hits.sum()) - np.repeat(np.cumsum(hits) - hits, hits)]
+    # Elements sharing several cells meet once per cell
+    pairs = np.unique(a * len(bounds_b) + b)
+    a, b = pairs // len(bounds_b), pairs % len(bounds_b)
+    touching = ((bounds_a[a, 0] <= bounds_b[b, 2]) & (bounds_b[b, 0] <= bounds_a[a, 2]) &
+                (bounds_a[a, 1] <= bounds_b[b, 3]) & (bounds_b[b, 1] <= bounds_a[a, 3]))
+    return a[touching], b[touching]
+
+
+def candidates(bounds_a, bounds_b, index='auto'):
+    '''
+    Pairs of elements whose bounds intersect
+    :param index: 'strtree', 'grid', or 'auto' for an STRtree when shapely 2 is installed
+    :return: arrays of indices into a and into b, sorted by a then b
+    '''
+    if index == 'grid' or (index == 'auto' and not vectorized):
+        return grid_candidates(bounds_a, bounds_b)
+    if not len(bounds_a) or not len(bounds_b):
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    tree = shapely.STRtree(shapely.box(*bounds_b.T))
+    a, b = tree.query(shapely.box(*bounds_a.T), predicate='intersects')
+    order = np.lexsort((b, a))
+    return a[order], b[order]
+
+
+def overlaps(elements_a, elements_b, geometry='polygon', index='auto'):
+    '''
+    IoU and overlap of every pair of elements of a and b that intersect, a sparse version of
+    calculate_iou and calculate_overlap over all pairs. Overlap is the share of one element's area
+    inside the other. Pairs that only touch or involve an empty element are left out.
+    :param elements_a: see shapes
+    :param geometry: see shapes
+    :param index: see candidates
+    :return: dict of equal length arrays: a and b (indices), intersection, iou, overlap_a, overlap_b
+    '''
+    a_shapes = shapes(elements_a, geometry)
+    b_shapes = shapes(elements_b, geometry)
+    a, b = candidates(a_shapes.bounds, b_shapes.bounds, index)
+    keep = (a_shapes.areas[a] > 0) & (b_shapes.areas[b] > 0)
+    a, b = a[keep], b[keep]
+
+    bounds_a, bounds_b = a_shapes.bounds[a], b_shapes.bounds[b]
+    width = np.minimum(bounds_a[:, 2], bounds_b[:, 2]) - np.maximum(bounds_a[:, 0], bounds_b[:, 0])
+    height = np.minimum(bounds_a[:, 3], bounds_b[:, 3]) - np.maximum(bounds_a[:, 1], bounds_b[:, 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    # Bounds overlap is exact for two rectangles, and an upper bound otherwise
+    irregular = ~(a_shapes.rect[a] & b_shapes.rect[b]) & (intersection > 0)
+    if irregular.any():
+        intersection[irregular] = shapely.area(shapely.intersection(a_shapes.geometry(a[irregular]),
+                                                                    b_shapes.geometry(b[irregular])))
+
+    positive = intersection > 0
+    a, b, intersection = a[positive], b[positive], intersection[positive]
+    area_a, area_b = a_shapes.areas[a], b_shapes.areas[b]
+    return {
+        'a': a,
+        'b': b,
+        'intersection': intersection,
+        'iou': intersection / (area_a + area_b - intersection),
+        'overlap_a': intersection / area_a,
+        'overlap_b': intersection / area_b
+    }
+
+
+def best_matches(pairs, min_score=0.5, score='iou'):
+    '''
+    One to one matches between a and b, greedily taking the highest scoring pair left
+    whose elements are both still unmatched
+    :param pairs: result of overlaps
+    :param min_score: lowest score a match may have
+    :param score: 'iou', 'overlap_a' or 'overlap_b'
+    :return: arrays a, b and score of the matches, best first
+    '''
+    scores = pairs[score]
+    keep = np.flatnonzero(scores >= min_score)
+    order = keep[np.argsort(-scores[keep], kind='stable')]
+    matched_a, matched_b = set(), set()
+    chosen = []
+    for pair, a, b in zip(order, pairs['a'][order].tolist(), pairs['b'][order].tolist()):
+        if a in matched_a or b in matched_b:
+            continue
+        matched_a.add(a)
+        matched_b.add(b)
+        chosen.append(pair)
+    chosen = np.array(chosen, dtype=np.int64)
+    return pairs['a'][chosen], pairs['b'][chosen], scores[chosen]
+
+
+def match(elements_a, elements_b, min_iou=0.5, geometry='polygon', index='auto'):
+    '''
+    Best one to one IoU matches between the elements of a and b, see overlaps and best_matches
+    :return: dict of arrays a, b and iou of the matches, and of the indices of unmatched_a and unmatched_b
+    '''
+    a_shapes = shapes(elements_a, geometry)
+    b_shapes = shapes(elements_b, geometry)
+    a, b, iou = best_matches(overlaps(a_shapes, b_shapes, index=index), min_iou)
+    return {
+        'a': a,
+        'b': b,
+        'iou': iou,
+        'unmatched_a': np.setdiff1d(np.arange(len(a_shapes)), a),
+        'unmatched_b': np.setdiff1d(np.arange(len(b_shapes)), b)
+    }
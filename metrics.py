@@ -0,0 +1,192 @@
+import sys
+import json
+import time
+import random
+import resource
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Stage timers, counters and peak memory for one source job, written once per job as a CloudWatch
+# Embedded Metric Format (EMF) line, and sampled debug logging for the per-row hot paths.
+# Standard library only, so the webhook path can use it without loading the pipeline.
+
+
+# Internal settings:
+
+namespace = 'AudioAnnotationQA'  # CloudWatch namespace the job metrics are published under
+debug_sample_rate = 0.01  # Share of debug() calls that are logged
+
+logger = logging.getLogger()
+
+# Metrics of the job running in this thread, copied into pool threads by in_context
+current = contextvars.ContextVar('job_metrics', default=None)
+
+
+class JobMetrics:
+    '''
+    Stage timers (milliseconds, summed across threads), counters and gauges (highest value seen)
+    of one source job
+    '''
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, name, ms):
+        with self.lock:
+            self.timers[name] += ms
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def peak(self, name, value):
+        with self.lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def snapshot(self):
+        '''
+        Returns the timers, counters and gauges as plain dicts, see merge
+        '''
+        with self.lock:
+            return {'timers': dict(self.timers), 'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def emf(self):
+        '''
+        Returns the metrics as an EMF document with the job_id as its only dimension
+        '''
+        with self.lock:
+            values = {f'{name}_ms': round(ms, 1) for name, ms in self.timers.items()}
+            values.update(self.counters)
+            values.update(self.gauges)
+        definitions = [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else
+                        'Bytes' if name.endswith('bytes') else 'Count'} for name in values]
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [['JobId']], 'Metrics': definitions}]
+            },
+            'JobId': str(self.job_id),
+            **values
+        }
+
+
+def measure_job(handler):
+    '''
+    Decorates handler(job_id, ...) so everything it measures is collected for job_id
+    and written as one EMF line when it returns or raises
+    '''
+    def wrapper(job_id, *args, **kwargs):
+        metrics = JobMetrics(job_id)
+        token = current.set(metrics)
+        try:
+            with stage('job'):
+                return handler(job_id, *args, **kwargs)
+        finally:
+            current.reset(token)
+            # Lambda sends stdout to CloudWatch Logs, which turns EMF lines into metrics
+            print(json.dumps(metrics.emf()))
+    return wrapper
+
+
+def run_measured(job_id, func, *args):
+    '''
+    Runs func(*args) measured as job_id on its own, for work done in another process or invocation
+    :return: result of func and the snapshot of what it measured, to be merged into the job
+    '''
+    metrics = JobMetrics(job_id)
+    token = current.set(metrics)
+    try:
+        return func(*args), metrics.snapshot()
+    finally:
+        current.reset(token)
+
+
+def merge(snapshot):
+    '''
+    Adds a snapshot from run_measured to the current job
+    '''
+    metrics = current.get()
+    if metrics is None:
+        return
+    for name, ms in snapshot['timers'].items():
+        metrics.add_time(name, ms)
+    for name, n in snapshot['counters'].items():
+        metrics.add(name, n)
+    for name, value in snapshot['gauges'].items():
+        metrics.peak(name, value)
+
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of the process in bytes, since start or the last reset_peak_rss
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Bytes on macOS, kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    '''
+    Starts the peak resident set size over from the current one, so a warm container
+    does not report the peak of an earlier invocation. Does nothing off Linux.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+@contextmanager
+def stage(name):
+    '''
+    Adds the wall time of the with block to the current job's name timer
+    and records the process peak RSS at its end as name_peak_rss_bytes
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current.get()
+        if metrics is not None:
+            metrics.add_time(name, (time.perf_counter() - start) * 1000)
+            metrics.peak(f'{name}_peak_rss_bytes', peak_rss())
+
+
+def count(name, n=1):
+    '''
+    Adds n to the current job's name counter
+    '''
+    metrics = current.get()
+    if metrics is not None:
+        metrics.add(name, n)
+
+
+def in_context(func):
+    '''
+    Wraps func to run in a copy of the caller's context, so work handed to a thread pool
+    is still measured for the caller's job
+    '''
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def debug(message, *args):
+    '''
+    Logs message % args for debug_sample_rate of calls. The message is only formatted when logged.
+    '''
+    if debug_sample_rate and random.random() < debug_sample_rate:
+        logger.info(message, *args)
@@ -0,0 +1,253 @@
+import os
+import sys
+import pickle
+import atexit
+import threading
+import multiprocessing
+from functools import partial
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+# Process pool for DataFrame work in the batch scripts, kept between calls. A frame is written once
+# into a shared memory block: fixed width columns (numbers, booleans, datetimes) as raw arrays that
+# workers map without copying, the other columns pickled once per chunk. Tasks only carry the block
+# name and the chunk bounds, and chunk results come back as they finish.
+
+
+# Internal settings:
+
+chunks_per_worker = 4  # Chunks each worker gets on average, so slow chunks do not hold up the rest
+
+
+def available_cores():
+    '''
+    Cores this process may run on, which can be fewer than the machine has in a container
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+pool = None
+pool_workers = None
+# Ids of the __main__ functions a forked pool was started with, see function_changed
+pool_main = None
+pool_lock = threading.Lock()
+
+
+def main_functions():
+    main = sys.modules.get('__main__')
+    return {name: id(value) for name, value in vars(main).items() if callable(value)} if main else {}
+
+
+def function_changed(func):
+    '''
+    True if func is defined in __main__ but is not the function of that name the pool's workers were
+    forked with, e.g. it was defined or redefined in a notebook after the pool started
+    '''
+    if pool_main is None:
+        return False
+    if isinstance(func, partial):
+        return any(function_changed(part) for part in (func.func, *func.args))
+    if not callable(func) or getattr(func, '__module__', None) != '__main__':
+        return False
+    return pool_main.get(getattr(func, '__qualname__', None)) != id(func)
+
+
+def get_pool(workers=None, func=None):
+    '''
+    Returns the pool shared by every call, starting it on first use with workers processes
+    (available_cores() if None), and restarting it for a different size or a changed __main__ function
+    '''
+    global pool, pool_workers, pool_main
+    workers = workers or available_cores()
+    with pool_lock:
+        if pool is not None and (workers != pool_workers or function_changed(func)):
+            pool.shutdown()
+            pool = None
+        if pool is None:
+            context = multiprocessing.get_context()
+            pool_main = main_functions() if context.get_start_method() == 'fork' else None
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            pool_workers = workers
+        return pool
+
+
+def shutdown_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown()
+            pool = None
+
+
+atexit.register(shutdown_pool)
+
+
+def fixed_width(dtype):
+    return isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM'
+
+
+class SharedFrame:
+    '''
+    A DataFrame cut into chunks in one shared memory block, unlinked by close
+    '''
+
+    def __init__(self, data, bounds):
+        self.rows = len(data)
+        self.columns = data.columns
+        self.bounds = bounds
+        fixed = [position for position, dtype in enumerate(data.dtypes) if fixed_width(dtype)]
+        rest = [position for position, dtype in enumerate(data.dtypes) if not fixed_width(dtype)]
+        index = data.index
+        if isinstance(index, pd.RangeIndex):
+            self.index = ('range', index.start, index.step, index.name)
+        elif isinstance(index, pd.MultiIndex) or not fixed_width(index.dtype):
+            self.index = ('pickled', None, None, None)
+        else:
+            self.index = ('shared', None, None, index.name)
+        arrays = [(position, np.ascontiguousarray(data.iloc[:, position].to_numpy())) for position in fixed]
+        if self.index[0] == 'shared':
+            arrays.append((-1, np.ascontiguousarray(index.to_numpy())))
+        pickles = []
+        if rest or self.index[0] == 'pickled':
+            for start, stop in bounds:
+                part = data.iloc[start:stop, rest]
+                pickles.append(pickle.dumps((part.index if self.index[0] == 'pickled' else None,
+                                             [part.iloc[:, i] for i in range(len(rest))]), pickle.HIGHEST_PROTOCOL))
+        size = sum(array.nbytes for _, array in arrays) + sum(len(chunk) for chunk in pickles)
+        self.block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        offset = 0
+        self.fixed = []
+        for position, array in arrays:
+            np.ndarray(array.shape, array.dtype, self.block.buf, offset)[:] = array
+            self.fixed.append((position, array.dtype.str, offset))
+            offset += array.nbytes
+        self.rest = rest
+        self.pickles = []
+        for chunk in pickles:
+            self.block.buf[offset:offset + len(chunk)] = chunk
+            self.pickles.append((offset, len(chunk)))
+            offset += len(chunk)
+
+    def task(self, chunk):
+        '''
+        What a worker needs to rebuild chunk, which does not include any of its data
+        '''
+        start, stop = self.bounds[chunk]
+        return (self.block.name, self.rows, self.columns, self.fixed, self.rest, self.index,
+                self.pickles[chunk] if self.pickles else None, start, stop)
+
+    def close(self):
+        self.block.close()
+        self.block.unlink()
+
+
+# Block a worker has mapped, kept open until the next one arrives
+attached = {}
+
+
+def attach(name):
+    if name not in attached:
+        for old in list(attached):
+            try:
+                attached.pop(old).close()
+            except BufferError:
+                # A result still holds a view of it, it is unmapped when the worker exits
+                pass
+        attached[name] = shared_memory.SharedMemory(name=name)
+    return attached[name]
+
+
+def rebuild(task):
+    '''
+    Rebuilds a chunk of a SharedFrame in a worker, fixed width columns as views of the shared block
+    '''
+    name, rows, columns, fixed, rest, index, pickled, start, stop = task
+    block = attach(name)
+    data = {}
+    for position, dtype, offset in fixed:
+        data[position] = np.ndarray((rows,), np.dtype(dtype), block.buf, offset)[start:stop]
+    index_values = data.pop(-1, None)
+    pickled_index = None
+    if pickled is not None:
+        offset, length = pickled
+        pickled_index, series = pickle.loads(block.buf[offset:offset + length])
+        for position, values in zip(rest, series):
+            data[position] = values.to_numpy() if isinstance(values.dtype, np.dtype) else values.array
+    kind, range_start, range_step, index_name = index
+    if kind == 'range':
+        new_index = pd.RangeIndex(range_start + start * range_step, range_start + stop * range_step, range_step,
+                                  name=index_name)
+    elif kind == 'shared':
+        new_index = pd.Index(index_values, name=index_name, copy=False)
+    else:
+        new_index = pickled_index
+    frame = pd.DataFrame({position: data[position] for position in range(len(columns))}, index=new_index, copy=False)
+    frame.columns = columns
+    return frame
+
+
+def run_task(func, task):
+    return task[-2], func(rebuild(task))
+
+
+def apply_rows(func, frame):
+    return frame.apply(func, axis=1)
+
+
+def chunk_bounds(rows, chunks):
+    edges = np.linspace(0, rows, chunks + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def imap_chunks(data, func, processes=None, chunks=None):
+    '''
+    Runs func(chunk) over chunks of data on the shared pool
+    :param func: picklable function of a DataFrame, e.g. a module or __main__ level function
+    :param processes: worker processes, available_cores() if None
+    :param chunks: number of chunks, chunks_per_worker per worker if None
+    :return: generator of (position of the chunk's first row, result) in completion order
+    '''
+    executor = get_pool(processes, func)
+    bounds = chunk_bounds(len(data), chunks or pool_workers * chunks_per_worker)
+    shared = SharedFrame(data, bounds)
+    try:
+        futures = [executor.submit(run_task, func, shared.task(chunk)) for chunk in range(len(bounds))]
+        for future in as_completed(futures):
+            yield future.result()
+    except BrokenProcessPool:
+        shutdown_pool()
+        raise
+    finally:
+        shared.close()
+
+
+def imap_rows(data, func, processes=None, chunks=None):
+    '''
+    Runs data.apply(func, axis=1) chunk by chunk on the shared pool
+    :return: generator of (position of the chunk's first row, results of its rows) in completion order
+    '''
+    return imap_chunks(data, partial(apply_rows, func), processes, chunks)
+
+
+def parallelize(data, func, processes=None, chunks=None):
+    '''
+    Runs func over chunks of data on the shared pool and concatenates the results in row order
+    '''
+    if not len(data):
+        return func(data)
+    results = sorted(imap_chunks(data, func, processes, chunks), key=lambda result: result[0])
+    return pd.concat([result for _, result in results])
+
+
+def parallelize_on_rows(data, func, processes=None, chunks=None):
+    '''
+    data.apply(func, axis=1) on the shared pool
+    '''
+    return parallelize(data, partial(apply_rows, func), processes, chunks)
@@ -0,0 +1,1140 @@
+import os
+import datetime
+import time
+import zipfile
+import gzip
+import json
+import io
+import random
+import tempfile
+import hashlib
+import uuid
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from metrics import measure_job, stage, count, in_context, debug, run_measured, merge
+from transfer import list_keys, get_object, put_object, get_objects, put_objects, delete_objects
+
+from lambda_function import (logger, get_s3_client, get_appen, get_lambda_client, registry, bucket, max_tries,
+                             poll_base_s, poll_max_s, report_deadline_s, report_chunksize, chunk_rows, job_row_budget,
+                             chunk_reserve_ms, upload_chunk_bytes, upload_tries, upload_gzip, fetch_workers,
+                             host_workers, anno_cache_items, anno_cache_bytes, anno_cache_folder, reconcile_s,
+                             job_info_ttl_s, watermark_folder, watermark_store, queue_folder, results_header,
+                             full_report_columns, category_columns, map_mode, map_rows, map_workers, map_function,
+                             map_payload_bytes, map_folder, unit_tries, unit_retry_s, dead_letter_folder, appen_tries)
+
+# Report pipeline run for each source job on the timer signal, see job_handler
+
+def get_job(job_id):
+    '''
+    Reads the job JSON of job_id (title, judgments_count, ...)
+    :return: the job as a dict, or None on error
+    '''
+    response = get_appen().job(job_id, appen_tries)
+    if response.status_code != 200:
+        print(
+            f'---- Status code: {response.status_code} \n {response.text}')
+    else:
+        print('---- Success!')
+        return json.loads(response.text)
+
+def get_job_title(job_id, metadata, ttl_s=job_info_ttl_s):
+    '''
+    Returns the title of job_id from its registry metadata if read within ttl_s,
+    or from Appen otherwise, noting it in the registry
+    '''
+    if metadata.get('title') is not None and time.time() - (metadata.get('info_at') or 0) < ttl_s:
+        return metadata['title']
+    job = get_job(job_id)
+    if job is None:
+        return metadata.get('title')
+    registry.note(job_id, title=job['title'], info_at=time.time())
+    return job['title']
+
+class AnnotationCache:
+    '''
+    Two tier cache of fetched annotations: an in-memory LRU of max_items entries
+    backed by files in folder holding at most max_bytes, oldest evicted first.
+    Both tiers live as long as the container, so warm invocations reuse them.
+    Values must be JSON serializable.
+    '''
+
+    def __init__(self, max_items, folder, max_bytes):
+        self.max_items = max_items
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'memory_evictions': 0, 'disk_evictions': 0}
+        # Files left by an earlier invocation on this container, oldest first
+        os.makedirs(folder, exist_ok=True)
+        entries = sorted(os.scandir(folder), key=lambda entry: entry.stat().st_mtime)
+        self.disk = OrderedDict((entry.name, entry.stat().st_size) for entry in entries)
+        self.disk_bytes = sum(self.disk.values())
+
+    def filename(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        name = self.filename(key)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self.memory[key]
+            if name not in self.disk:
+                self.counters['misses'] += 1
+                return None
+            self.disk.move_to_end(name)
+        try:
+            with open(f'{self.folder}/{name}') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+        with self.lock:
+            self.counters['disk_hits'] += 1
+            self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        name = self.filename(key)
+        data = json.dumps(value)
+        with self.lock:
+            self.remember(key, value)
+            self.disk_bytes += len(data) - self.disk.pop(name, 0)
+            self.disk[name] = len(data)
+            while self.disk_bytes > self.max_bytes and len(self.disk) > 1:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                self.counters['disk_evictions'] += 1
+                try:
+                    os.remove(f'{self.folder}/{evicted}')
+                except OSError:
+                    pass
+        fd, path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(path, f'{self.folder}/{name}')
+
+    def remember(self, key, value):
+        # Callers hold self.lock
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+            self.counters['memory_evictions'] += 1
+
+    def evict(self, key):
+        name = self.filename(key)
+        with self.lock:
+            self.memory.pop(key, None)
+            self.disk_bytes -= self.disk.pop(name, 0)
+        try:
+            os.remove(f'{self.folder}/{name}')
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+anno_cache = AnnotationCache(anno_cache_items, anno_cache_folder, anno_cache_bytes)
+
+def get_anno_path(s3_path):
+    debug('get_anno_path %s', s3_path)
+    bucket = s3_path.split('/')[2]
+    filepath = "/".join(s3_path.split('/')[3:])
+    # A cached copy is only used while its ETag still matches the object
+    cached = anno_cache.get(s3_path)
+    try:
+        if cached is None:
+            result = get_object(get_s3_client(), bucket, filepath)
+        else:
+            result = get_object(get_s3_client(), bucket, filepath, IfNoneMatch=cached['etag'])
+    except:
+        return False
+    if result['status'] == 'not_modified':
+        count('cache_hits')
+        return cached['body']
+    if result['status'] != 'success':
+        return False
+    s3_clientdata = result['body'].decode('utf-8')
+    count('annotation_bytes', len(s3_clientdata))
+    count('retries', result['retries'])
+    anno_cache.put(s3_path, {'etag': result['etag'], 'body': s3_clientdata})
+    return s3_clientdata
+    
+def get_anno_url_old(anno_url):
+    response = get_appen().annotation(anno_url, appen_tries)
+    anno_transcribed = response.json()
+    return anno_transcribed
+    
+def get_anno_url(obj):
+    if '{' in obj:
+        json_obj = json.loads(obj)
+        url = json_obj['url']
+        debug('get_anno_url %s -> %s', obj, url)
+        anno_url = url.replace('requestor-proxy.appen.com','api-beta.appen.com') + f"&key={os.environ['API_KEY']}"
+    else:
+        anno_url = obj
+    cached = anno_cache.get(anno_url)
+    if cached is not None:
+        count('cache_hits')
+        return json.loads(cached)
+    response = get_appen().annotation(anno_url, appen_tries)
+    count('annotation_bytes', len(response.content))
+    # An error body (404, 403, a 429 left after appen_tries) fails the row instead of standing in for its annotation
+    response.raise_for_status()
+    anno_transcribed = response.json()
+    anno_cache.put(anno_url, response.text)
+    return anno_transcribed
+
+def run_all(values, func, workers=fetch_workers):
+    '''
+    Runs func over every value on a bounded thread pool
+    :param values: Series of inputs, e.g. annotation references
+    :param func: function taking a single value, e.g. get_anno_url
+    :param workers: max number of concurrent calls
+    :return: Series of results in row order (None where the call failed)
+             and a dict of index -> exception for the failed rows
+    '''
+    def run_one(item):
+        index, value = item
+        try:
+            return index, func(value), None
+        except Exception as e:
+            return index, None, e
+
+    results = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, result, error in executor.map(in_context(run_one), values.items()):
+            results.append(result)
+            if error is not None:
+                errors[index] = error
+    return pd.Series(results, index=values.index, dtype=object), errors
+
+class Utterance:
+    '''
+    Original and transcribed annotation of one utterance. Slotted and holding the parsed utterances
+    as they are, so the per-utterance sample wrappers are only built when the utterance is hosted.
+    '''
+    __slots__ = ('original', 'transcribed')
+
+    def __init__(self, original, transcribed):
+        self.original = original
+        self.transcribed = transcribed
+
+    def sample0(self):
+        return {'annotation': [[self.original]], "nothingToAnnotate": False}
+
+    def sample1(self):
+        return {'annotation': [[self.transcribed]], "nothingToAnnotate": False, "ableToAnnotate": True,
+                "nothingToTranscribe": False}
+
+def repeat_categorical(values, positions):
+    '''
+    Takes values at positions as a Categorical, so values repeated for every utterance of a unit are held once
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, categories = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, categories = pd.factorize(values)
+    return pd.Categorical.from_codes(codes[positions], categories)
+
+def transcription(anno1):
+    '''
+    True if anno1 is shaped like a transcription: a dict whose annotation is empty or holds
+    a list of utterance dicts with an id
+    '''
+    if not isinstance(anno1, dict) or not isinstance(anno1.get('annotation'), list):
+        return False
+    if not anno1['annotation']:
+        return True
+    return isinstance(anno1['annotation'][0], list) and all(isinstance(utt1, dict) and 'id' in utt1
+                                                            for utt1 in anno1['annotation'][0])
+
+def get_utts(df1):
+    '''
+    Extracts utterances from annotation, pairing every transcribed utterance (anno1)
+    with the original utterance (anno0) of the same id
+    :param df1: origin job rows with anno0 and anno1 fetched
+    :return: DataFrame with one Utterance per row, a list of (unit_id, utterance id)
+             for transcribed utterances with no original and a list of the unit_ids whose anno1
+             is not a transcription
+    '''
+    positions = []
+    utts = []
+    missing = []
+    malformed = []
+    for position, (anno0, anno1, unit_id) in enumerate(zip(df1['anno0'], df1['anno1'], df1['_unit_id'])):
+        if not anno0:
+            continue
+        if not transcription(anno1):
+            malformed.append(unit_id)
+            continue
+        if anno1.get('nothingToTranscribe') or not len(anno1['annotation']):
+            continue
+        originals = {utt0['id']: utt0 for utt0 in json.loads(anno0)['annotation']}
+        for utt1 in anno1['annotation'][0]:
+            if utt1.get('nothingToTranscribe'):
+                continue
+            utt0 = originals.get(utt1['id'])
+            if utt0 is None:
+                missing.append((unit_id, utt1['id']))
+                continue
+            positions.append(position)
+            utts.append(Utterance(utt0, utt1))
+    positions = np.asarray(positions, dtype=np.intp)
+    columns = {'orig_worker_id': '_worker_id', 'audio_annotation_url': 'audio_annotation_url', 'audio_url': 'audio_url',
+               'orig_unit_id': '_unit_id', 'orig_created_at': '_created_at', 'display_id': 'display_id',
+               'duration': 'duration', 'pe_file_id': 'pe_file_id', 'pe_file_name': 'pe_file_name',
+               'pe_store_id': 'pe_store_id'}
+    df = pd.DataFrame({'utt': pd.Series(utts, dtype=object),
+                       **{column: repeat_categorical(df1[unit_column], positions)
+                          for column, unit_column in columns.items()}})
+    return df, missing, malformed
+
+def host_utt(bucket, job_id, utt):
+    '''
+    Hosts one utterance pair to s3 bucket
+    :param utt: tuple of audio_annotation_url, Utterance and orig_worker_id
+    :return: tuple of utterance and utterance_transcribed s3 paths
+    '''
+    audio_annotation_url, utt, worker = utt
+    sample0, sample1 = utt.sample0(), utt.sample1()
+    folder = "/".join(audio_annotation_url.split('/')[3:-1])
+    filename = audio_annotation_url.split('/')[-1].replace('.json','')
+    sample_id = utt.original['id']
+    utterance = f'QL1/QA/{job_id}/utterance/{folder}/{filename}_{sample_id}.json'
+    utterance_transcribed = f'QL1/QA/{job_id}/utterance_transcribed/{folder}/{filename}_{sample_id}_{worker}.json'
+    for key, body in ((utterance, json.dumps(sample0)), (utterance_transcribed, json.dumps(sample1))):
+        result = put_object(get_s3_client(), bucket, key, body)
+        count('hosted_bytes', result['bytes'])
+        count('retries', result['retries'])
+    return f's3://{bucket}/{utterance}', f's3://{bucket}/{utterance_transcribed}'
+
+def host_utts(df, bucket, job_id, workers=host_workers):
+    '''
+    Hosts utterances to s3 bucket on a bounded thread pool sharing the pooled S3 client
+    :return: Series of utterance paths, Series of utterance_transcribed paths (None where hosting failed)
+             and a dict of index -> exception for the rows that failed
+    '''
+    utts = pd.Series(list(zip(df['audio_annotation_url'], df['utt'], df['orig_worker_id'])),
+                     index=df.index, dtype=object)
+    paths, errors = run_all(utts, lambda utt: host_utt(bucket, job_id, utt), workers)
+    utterance = paths.map(lambda path: path and path[0])
+    utterance_transcribed = paths.map(lambda path: path and path[1])
+    return utterance, utterance_transcribed, errors
+
+def sample_seed(job_id, run):
+    '''
+    Seed that is the same every time a batch of job_id is sampled, so a rerun picks the same utterances
+    :param run: anything identifying the batch, e.g. the watermark it starts after
+    '''
+    return int.from_bytes(hashlib.sha256(f'{job_id}:{run}'.encode('utf-8')).digest()[:8], 'big')
+
+# sample utterances with a minimum of 1/contributor
+def sample(df, rate, seed):
+    '''
+    Samples int(rate * n) of each contributor's n utterances, at least 1, without replacement.
+    Every contributor is sampled at once by ranking a random key within each group.
+    '''
+    workers = df['orig_worker_id']
+    quota = np.maximum((workers.groupby(workers, dropna=False, observed=True).transform('size') * rate).astype(int), 1)
+    keys = pd.Series(np.random.default_rng(seed).random(len(df)), index=df.index)
+    return df[keys.groupby(workers, dropna=False, observed=True).rank(method='first') <= quota].copy()
+
+
+class S3WatermarkStore:
+    '''
+    Keeps one watermark per source job as a JSON object at S3://{bucket}/{folder}/{job_id}.json
+    A watermark is a dict with keys: qa_job, timestamp, reconciled_at, uploaded, queued and failures, see advance_watermark
+    '''
+
+    def __init__(self, bucket, folder):
+        self.bucket = bucket
+        self.folder = folder
+
+    def get(self, job_id):
+        result = get_object(get_s3_client(), self.bucket, f'{self.folder}/{job_id}.json')
+        if result['status'] == 'missing':
+            return None
+        return json.loads(result['body'])
+
+    def put(self, job_id, watermark):
+        # A single PUT replaces the object atomically
+        put_object(get_s3_client(), self.bucket, f'{self.folder}/{job_id}.json', json.dumps(watermark))
+
+class FileWatermarkStore:
+    '''
+    Keeps one watermark per source job as a local JSON file at {folder}/{job_id}.json, for testing
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, job_id):
+        try:
+            with open(f'{self.folder}/{job_id}.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, job_id, watermark):
+        # Write to a temp file and rename over the old one so readers never see a partial write
+        fd, path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(watermark, f)
+        os.replace(path, f'{self.folder}/{job_id}.json')
+
+def get_watermark_store(store):
+    '''
+    Returns the watermark store that watermark_store names
+    '''
+    if store == 's3':
+        return S3WatermarkStore(bucket, watermark_folder)
+    if store == 'file':
+        return FileWatermarkStore(watermark_folder)
+    raise ValueError(f'Unknown watermark_store {store}')
+
+watermarks = get_watermark_store(watermark_store)
+
+def later(rows, timestamp):
+    '''
+    Keeps the rows whose first item, a creation time, is later than timestamp
+    '''
+    return [row for row in rows if timestamp is None or pd.Timestamp(row[0]) > timestamp]
+
+def advance_watermark(job_1, job_2, timestamp, reconciled_at, uploaded=(), queued=(), failures=()):
+    '''
+    Records that every unit of job_1 created at or before timestamp has been handled
+    :param uploaded: [orig_created_at, utterance_transcribed] of rows job_2 already accepted from later units,
+                     which a rerun must not send again
+    :param queued: [_created_at, _unit_id] of later units already sampled from the queue,
+                   which the full report must leave out
+    :param failures: [_created_at, _unit_id, runs, first_failed_at] of later units that failed on earlier runs,
+                     see give_up
+    :return: the uploaded rows, queued units and failures kept, which leaves out those the timestamp covers
+    '''
+    uploaded, queued, failures = later(uploaded, timestamp), later(queued, timestamp), later(failures, timestamp)
+    watermarks.put(job_1, {
+        'qa_job': int(job_2),
+        'timestamp': None if timestamp is None else str(timestamp),
+        'reconciled_at': reconciled_at,
+        'uploaded': uploaded,
+        'queued': queued,
+        'failures': failures
+    })
+    return uploaded, queued, failures
+
+def pass_skipped(timestamp, skipped, until=None):
+    '''
+    Moves timestamp over the creation times of skipped units, which were handled before, that are earlier
+    than until, the creation time of the oldest unit still to handle (None when none is left)
+    :param skipped: sorted datetime64 array
+    '''
+    if until is not None:
+        skipped = skipped[:np.searchsorted(skipped, until)]
+    if len(skipped) and (timestamp is None or skipped[-1] > timestamp.to_datetime64()):
+        timestamp = pd.Timestamp(skipped[-1])
+    return timestamp
+
+def poll(send, max_tries, deadline):
+    '''
+    Calls send until it returns a 200, sleeping with exponential backoff and full jitter between tries
+    :param send: function making one request and returning the response
+    :param max_tries: max number of requests
+    :param deadline: time.monotonic() value after which polling gives up
+    :return: the 200 response, or None if max_tries or the deadline ran out first
+    '''
+    for counter in range(1, max_tries + 1):
+        response = send()
+        print(f'-- Response: {response.status_code} -- {str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))} -- Count:{counter}')
+        if response.status_code == 200:
+            return response
+        # A streamed response holds its pooled connection until it is closed. The short answer is read
+        # first so closing hands the connection back to the pool rather than dropping it.
+        response.content
+        response.close()
+        count('report_polls')
+        delay = random.uniform(0, min(poll_max_s, poll_base_s * 2 ** counter))
+        if time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+    return None
+
+def regenerate_report(job_id, report_type, max_tries, deadline):
+    '''
+    Takes in a job ID, report type, max_tries and a time.monotonic() deadline
+    '''
+    response = poll(lambda: get_appen().regenerate(job_id, report_type), max_tries, deadline)
+    if response is None:
+        logger.info(f'Could not regenerate {job_id} {report_type} report, downloading the last one')
+        return False
+    print(f'Regenerated {job_id} {report_type} report!')
+    return True
+
+def get_report(job_id, report_type, max_tries, deadline):
+    '''
+    Takes in a job ID, report type, max_tries and a time.monotonic() deadline
+    :return: the report zip, held in memory
+    '''
+    response = poll(lambda: get_appen().report(job_id, report_type), max_tries, deadline)
+    if response is None:
+        raise TimeoutError(f'{report_type} report for job {job_id} was not ready in time')
+    print(f'Download complete for job {job_id}, reading {report_type} report')
+    body = io.BytesIO()
+    for chunk in response.iter_content(chunk_size=1024 * 1024):
+        # The read timeout only bounds each wait for bytes, not a slow download as a whole
+        if time.monotonic() > deadline:
+            response.close()
+            raise TimeoutError(f'{report_type} report for job {job_id} did not download in time')
+        body.write(chunk)
+    count('report_bytes', body.tell())
+    return zipfile.ZipFile(body)
+
+def read_report(zf, columns, time_column=None, after=None, categories=()):
+    '''
+    Parses the report csv in chunks, keeping only columns and, when after is given,
+    only rows whose time_column is later than after. Columns in categories are made categorical.
+    :param zf: report zip from get_report
+    :return: DataFrame of the kept rows and the last row of the report as a dict (None if the report is empty)
+    '''
+    chunks = []
+    last = None
+    with stage('parse'), zf.open(zf.namelist()[0]) as csvfile:
+        for chunk in pd.read_csv(csvfile, usecols=lambda column: column in columns, chunksize=report_chunksize):
+            if len(chunk):
+                last = {column: chunk[column].iloc[-1] for column in chunk}
+            if after is not None:
+                chunk = chunk[pd.to_datetime(chunk[time_column]) > after]
+            chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns=columns), last
+    df = pd.concat(chunks)
+    for column in categories:
+        df[column] = df[column].astype('category')
+    return df, last
+
+def fetch_report(job_id, report_type, deadline=None):
+    '''
+    Regenerates and downloads one report within its own report_deadline_s
+    :param deadline: time.monotonic() value the invocation ends at. The report must also be ready
+                     chunk_reserve_ms before it, as one that comes later leaves no time to process it.
+    '''
+    end = time.monotonic() + report_deadline_s
+    deadline = end if deadline is None else min(end, deadline - chunk_reserve_ms / 1000)
+    if time.monotonic() >= deadline:
+        raise TimeoutError(f'No time left to read the {report_type} report for job {job_id}')
+    with stage('regenerate'):
+        regenerate_report(job_id,report_type,max_tries,deadline)
+    with stage('download'):
+        return get_report(job_id,report_type,max_tries,deadline)
+
+def fetch_reports(reports, deadline=None):
+    '''
+    Regenerates and downloads several reports at once
+    :param reports: list of (job_id, report_type)
+    :param deadline: see fetch_report
+    :return: list of report zips in the same order as reports
+    '''
+    with ThreadPoolExecutor(max_workers=len(reports)) as executor:
+        futures = [executor.submit(in_context(fetch_report), job_id, report_type, deadline)
+                   for job_id, report_type in reports]
+        return [future.result() for future in futures]
+
+def csv_chunks(df, max_bytes, rows_per_write=500):
+    '''
+    Serializes df to CSV in memory, split into bodies of at most max_bytes that each start with the header.
+    Rows are written rows_per_write at a time, halving a write that does not fit until it does, so only
+    a single row larger than max_bytes makes a larger body, holding that row alone.
+    :return: generator of (rows, body bytes)
+    '''
+    header = df.iloc[:0].to_csv(index=False).encode('utf-8')
+    parts, size, rows = [header], len(header), 0
+    # Row ranges still to write, the next one last
+    pending = [(start, min(start + rows_per_write, len(df))) for start in reversed(range(0, len(df), rows_per_write))]
+    while pending:
+        start, stop = pending.pop()
+        part = df.iloc[start:stop].to_csv(index=False, header=False).encode('utf-8')
+        if size + len(part) > max_bytes and stop - start > 1:
+            middle = (start + stop) // 2
+            pending += [(middle, stop), (start, middle)]
+            continue
+        if rows and size + len(part) > max_bytes:
+            yield rows, b''.join(parts)
+            parts, size, rows = [header], len(header), 0
+        parts.append(part)
+        size += len(part)
+        rows += stop - start
+    if rows:
+        yield rows, b''.join(parts)
+
+def send_upload(job_id, body, tries=upload_tries):
+    '''
+    Posts one CSV body to job_id, retrying connection errors, 429s and 5xxs, see AppenClient.request
+    :return: the last response, or raises the last connection error
+    '''
+    headers = {'Content-Type': 'text/csv'}
+    if upload_gzip:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    response = get_appen().upload(job_id, body, headers, tries)
+    count('upload_bytes', len(body))
+    return response
+
+def upload_report(df, job_id, max_bytes=upload_chunk_bytes):
+    '''
+    Uploads the rows of df to job_id as CSV, in requests of at most max_bytes
+    :return: list of (rows, response) per request sent, in row order, stopping after the first that was not accepted
+    '''
+    results = []
+    for rows, body in csv_chunks(df, max_bytes):
+        response = send_upload(job_id, body)
+        results.append((rows, response))
+        if response.status_code != 200:
+            break
+    return results
+    
+def read_queue(job_id):
+    '''
+    Reads the units of job_id queued by unit_complete webhooks, see queue_units
+    :return: DataFrame shaped like the full report, with the key of every unit in queue_key
+    '''
+    keys = list(list_keys(get_s3_client(), bucket, f'{queue_folder}/{job_id}/'))
+    units = {}
+    for result in get_objects(get_s3_client(), bucket, keys, fetch_workers):
+        if result['status'] != 'success':
+            logger.info(f'Could not read queued unit {result["key"]}: {result["status"]}')
+            continue
+        units[result['key']] = json.loads(result['body'])
+    if not units:
+        return pd.DataFrame(columns=['_created_at', 'queue_key'])
+    # Listing order, whatever order the reads finished in
+    keys = [key for key in keys if key in units]
+    queued = pd.DataFrame([units[key] for key in keys])
+    queued['queue_key'] = keys
+    # Webhooks send ISO 8601 times with an offset, the reports naive UTC ones
+    queued['_created_at'] = pd.to_datetime(queued['_created_at'], utc=True).dt.tz_localize(None).astype(str)
+    count('queued', len(queued))
+    return queued
+
+def covered(queued, timestamp):
+    '''
+    Keys of the queued units created at or before timestamp
+    '''
+    if not len(queued) or timestamp is None:
+        return []
+    return queued['queue_key'][pd.to_datetime(queued['_created_at']) <= timestamp]
+
+def clear_queue(keys):
+    '''
+    Deletes queued units that have been sampled or that the watermark covers
+    '''
+    keys = list(keys)
+    if not keys:
+        return
+    errors = delete_objects(get_s3_client(), bucket, keys)
+    for error in errors:
+        logger.info(f'Could not delete queued unit {error["key"]}: {error["status"]}')
+    count('dequeued', len(keys) - len(errors))
+
+def read_new_units(job_1, watermark, job_2=None, deadline=None):
+    '''
+    Finds the units of job_1 newer than its watermark in its regenerated full report. When job_1 has
+    no watermark yet or its QA job changed, the watermark starts from the QA job source report instead.
+    :param job_2: QA job ID last seen for job_1, used when there is no watermark
+    :param deadline: time.monotonic() value the invocation ends at, see fetch_report
+    :return: None on error, else new units, QA job ID, sample rate and watermark timestamp
+    '''
+    job_2 = watermark['qa_job'] if watermark else job_2
+    if watermark is None and job_2 is not None:
+        report1, report2 = fetch_reports([(job_1, 'full'), (job_2, 'source')], deadline)
+    else:
+        report1, = fetch_reports([(job_1, 'full')], deadline)
+        report2 = None
+    
+    _, last = read_report(report1, ['qa_job', 'sample'])
+    if last is None:
+        logger.info(f'No rows in origin job {job_1}!')
+        return None
+    try:
+        qa_job = last['qa_job']
+    except Exception as e:
+        logger.info(f'Could not get QA Job ID from {job_1}!')
+        logger.info(e)
+        return None
+    try:
+        sample_pct = last['sample']
+    except Exception as e:
+        logger.info(f'Could not get sample rate from {job_1}!')
+        logger.info(e)
+        return None
+    
+    if watermark is not None and qa_job == watermark['qa_job']:
+        # The stored watermark only moves over units of the full report that were all handled
+        timestamp = None if watermark['timestamp'] is None else pd.Timestamp(watermark['timestamp'])
+    else:
+        if qa_job != job_2:
+            job_2 = qa_job
+            report2 = None
+        if report2 is None:
+            report2, = fetch_reports([(job_2, 'source')], deadline)
+        df2, _ = read_report(report2, ['orig_created_at'])
+        try:
+            timestamp = pd.to_datetime(df2['orig_created_at']).max() if len(df2) else None
+        except ValueError:
+            # Units uploaded from the queue and from full reports write their times differently
+            timestamp = df2['orig_created_at'].map(pd.Timestamp).max()
+    
+    if timestamp is not None:
+        logger.info(f'most recent timestamp in QA job: {str(timestamp)}')
+        df1, _ = read_report(report1, full_report_columns, '_created_at', timestamp, category_columns)
+    else:
+        logger.info(f'No rows in QA Job {job_2}! ')
+        df1, _ = read_report(report1, full_report_columns, categories=category_columns)
+    return df1, job_2, sample_pct, timestamp
+
+@measure_job
+def job_handler(job_1, deadline=None, metadata=None):
+    '''
+    Samples the units of source job job_1 added since its watermark into its QA job
+    :param deadline: time.monotonic() value the invocation ends at, which no report or new chunk may run into
+    :param metadata: registry metadata of job_1
+    '''
+   
+    # Units queued by unit_complete webhooks are sampled without regenerating the full report, and recorded
+    # in the watermark without moving its timestamp. The full report is read once nothing is queued and
+    # there are new judgments, and at least every reconcile_s, and its units that are neither covered
+    # by the timestamp nor sampled from the queue are sampled then, which includes units whose webhook was lost.
+    # The timestamp moves over the units sampled from the queue as the walk through the report passes them.
+    metadata = metadata or {}
+    watermark = watermarks.get(job_1)
+    reconcile = watermark is None or time.time() - watermark['reconciled_at'] > reconcile_s
+    queued = read_queue(job_1)
+    # Units sampled from the queue that the timestamp does not cover yet, see advance_watermark
+    sampled = watermark.get('queued', []) if watermark else []
+    if watermark is not None and len(queued):
+        # A retried webhook queues a unit again after it was sampled
+        done = queued['_unit_id'].astype(str).isin({str(unit) for _, unit in sampled})
+        if watermark['timestamp'] is not None:
+            done |= pd.to_datetime(queued['_created_at']) <= pd.Timestamp(watermark['timestamp'])
+        clear_queue(queued['queue_key'][done])
+        queued = queued[~done].copy()
+    # Units of the full report left out as already sampled from the queue
+    skipped = np.array([], dtype='datetime64[ns]')
+    from_queue = not reconcile and len(queued) > 0 and int(queued['qa_job'].iloc[-1]) == watermark['qa_job']
+    if from_queue:
+        logger.info(f'Sampling {len(queued)} queued units of {job_1}')
+        df1, job_2, sample_pct = queued, watermark['qa_job'], float(queued['sample'].iloc[-1])
+        timestamp = None if watermark['timestamp'] is None else pd.Timestamp(watermark['timestamp'])
+        reconciled_at = watermark['reconciled_at']
+        judgments = None
+    else:
+        # An unchanged judgment count since the last complete run means there is nothing new to regenerate for
+        with stage('check'):
+            job = get_job(job_1)
+        judgments = None
+        if job is not None:
+            registry.note(job_1, title=job['title'], info_at=time.time())
+            metadata = {**metadata, 'title': job['title'], 'info_at': time.time()}
+            judgments = job.get('judgments_count')
+        if not reconcile and judgments is not None and judgments == metadata.get('judgments'):
+            logger.info(f'No new judgments in {job_1} since its last run')
+            return True
+        new_units = read_new_units(job_1, watermark, metadata.get('qa_job'), deadline)
+        if new_units is None:
+            return False
+        df1, job_2, sample_pct, timestamp = new_units
+        reconciled_at = time.time()
+        sampled = watermark.get('queued', []) if watermark and watermark['qa_job'] == int(job_2) else []
+        if sampled:
+            done = df1['_unit_id'].astype(str).isin({str(unit) for _, unit in sampled})
+            # The timestamp moves over them with the rows handled around them, which drops them from sampled
+            skipped = np.sort(pd.to_datetime(df1['_created_at'][done]).to_numpy())
+            df1 = df1[~done].copy()
+    registry.note(job_1, qa_job=int(job_2), sample=float(sample_pct))
+    # Rows of the next chunk the QA job accepted before an upload failed, see advance_watermark
+    uploaded = watermark.get('uploaded', []) if watermark and watermark['qa_job'] == int(job_2) else []
+    # Units that failed on earlier runs, see give_up
+    failures = watermark.get('failures', []) if watermark else []
+    
+    if len(df1) == 0:
+        logger.info('No new rows to sample!')
+        if not from_queue:
+            registry.note(job_1, backlog=0)
+            if judgments is not None:
+                registry.note(job_1, judgments=judgments)
+            timestamp = pass_skipped(timestamp, skipped)
+            advance_watermark(job_1, job_2, timestamp, reconciled_at, uploaded, sampled, failures)
+            clear_queue(covered(queued, timestamp))
+        return True
+    df1['_created_at_dt'] = pd.to_datetime(df1['_created_at'])
+    df1 = df1.sort_values(by='_created_at_dt', kind='stable')
+    count('rows', len(df1))
+    
+    title = get_job_title(job_1, metadata)
+    
+    # Work through the new units oldest first, checkpointing the watermark after every chunk,
+    # until they run out or the row or time budget does
+    created_at = df1['_created_at_dt'].to_numpy()
+    start = 0
+    complete = True
+    while start < len(df1):
+        if start >= job_row_budget:
+            logger.info(f'Row budget reached, leaving {len(df1) - start} new rows of {job_1} for the next run')
+            break
+        if deadline is not None and time.monotonic() > deadline - chunk_reserve_ms / 1000:
+            logger.info(f'Out of time, leaving {len(df1) - start} new rows of {job_1} for the next run')
+            break
+        # Rows sharing the chunk's last timestamp go in the same chunk, as the watermark can't split them
+        end = int(np.searchsorted(created_at, created_at[min(start + chunk_rows, len(df1)) - 1], side='right'))
+        handled, accepted, failures = process_chunk(df1.iloc[start:end].copy(), job_1, job_2, sample_pct, title,
+                                                    sample_seed(job_1, timestamp), uploaded, failures)
+        if handled is None:
+            # The rerun samples the same rows again and leaves the accepted ones out
+            advance_watermark(job_1, job_2, timestamp, reconciled_at, uploaded + accepted, sampled, failures)
+            complete = False
+            break
+        if handled:
+            if from_queue:
+                units = df1.iloc[start:start + handled]
+                sampled = sampled + [[created, str(unit)] for created, unit in zip(units['_created_at'], units['_unit_id'])]
+            else:
+                last = df1['_created_at_dt'].iloc[start + handled - 1]
+                timestamp = last if timestamp is None else max(timestamp, last)
+            count('chunks')
+        timestamp = pass_skipped(timestamp, skipped, created_at[start + handled] if start + handled < len(df1) else None)
+        # Also keeps the failures counted when no row was handled
+        uploaded, sampled, failures = advance_watermark(job_1, job_2, timestamp, reconciled_at, uploaded, sampled,
+                                                        failures)
+        if start + handled < end:
+            logger.info(f'Some units of {job_1} failed, leaving {len(df1) - start - handled} new rows from the oldest of them for the next run')
+            start += handled
+            complete = False
+            break
+        start = end
+    if from_queue:
+        clear_queue(df1['queue_key'].iloc[:start])
+    else:
+        registry.note(job_1, backlog=len(df1) - start)
+        if start == len(df1) and judgments is not None:
+            registry.note(job_1, judgments=judgments)
+        clear_queue(covered(queued, timestamp))
+    
+    return complete
+
+def fetch_pair(df1, job_id):
+    '''
+    Map stage: fetches the annotations of a chunk of unit rows and pairs their utterances
+    :return: DataFrame with one Utterance per row, see get_utts, and [_created_at, _unit_id, error]
+             of every unit whose annotations could not be fetched
+    '''
+    with stage('fetch'):
+        df1['anno1'], errors = run_all(df1[results_header], get_anno_url)
+    for index, error in errors.items():
+        logger.info(f'Could not fetch annotation for unit {df1["_unit_id"][index]}: {error}')
+    failed = [[str(df1['_created_at'][index]), str(df1['_unit_id'][index]), str(error)] for index, error in errors.items()]
+    df1 = df1.drop(index=list(errors))
+    
+    # filter out rows with no audio_transcription
+    df1 = df1[df1['anno1']!={'annotation': [], 'nothingToAnnotate': False, 'ableToAnnotate': False, 'nothingToTranscribe': True}]
+    
+    with stage('fetch'):
+        df1['anno0'], _ = run_all(df1['audio_annotation_url'], get_anno_path)
+    # get_anno_path answers False for an original it could not read
+    unread = df1.index[~df1['anno0'].astype(bool)]
+    for index in unread:
+        logger.info(f'Could not fetch original annotation for unit {df1["_unit_id"][index]}')
+    failed += [[str(df1['_created_at'][index]), str(df1['_unit_id'][index]), 'Could not fetch original annotation']
+               for index in unread]
+    count('fetch_errors', len(failed))
+    logger.info(f'Annotation cache: {anno_cache.stats()}')
+    
+    with stage('pair'):
+        df, missing, malformed = get_utts(df1)
+    count('utterances', len(df))
+    count('unpaired', len(missing))
+    count('malformed', len(malformed))
+    if missing:
+        logger.info(f'{len(missing)} transcribed utterances have no original and were skipped: {missing}')
+    if malformed:
+        logger.info(f'{len(malformed)} units have an annotation that is not a transcription and were skipped: {malformed}')
+    return df, failed
+
+def host_sample(df, job_id):
+    '''
+    Map stage: hosts a chunk of sampled utterances of job_id
+    :return: df with utterance and utterance_transcribed paths, without the utterances that failed,
+             and [orig_created_at, orig_unit_id, error] of every utterance that failed
+    '''
+    with stage('host'):
+        df['utterance'], df['utterance_transcribed'], errors = host_utts(df, bucket, job_id)
+    for index, error in errors.items():
+        logger.info(f'Could not host utterance of unit {df["orig_unit_id"][index]}: {error}')
+    logger.info(f'Hosted {len(df) - len(errors)} utterances to {bucket}, {len(errors)} failed')
+    count('host_errors', len(errors))
+    return df.drop(index=list(errors)), [[str(df['orig_created_at'][index]), str(df['orig_unit_id'][index]), str(error)]
+                                         for index, error in errors.items()]
+
+# Map stages by name, each taking a DataFrame and returning a DataFrame and [created_at, unit_id, error] of the units it failed on
+map_tasks = {'fetch_pair': fetch_pair, 'host': host_sample}
+
+def plan(df, rows):
+    '''
+    Splits df into map tasks of at most rows rows
+    '''
+    return [df.iloc[start:start + rows].copy() for start in range(0, len(df), rows)]
+
+def frame_to_json(df):
+    '''
+    Encodes a map task DataFrame for a sub-invocation, Utterances as [original, transcribed] and missing values as None
+    '''
+    columns = {}
+    for column in df:
+        if column == 'utt':
+            columns[column] = [[utt.original, utt.transcribed] for utt in df[column]]
+        else:
+            values = df[column].astype(object)
+            columns[column] = [value.item() if isinstance(value, np.generic) else value
+                               for value in values.where(values.notna(), None)]
+    return {'index': df.index.tolist(), 'columns': columns}
+
+def frame_from_json(frame):
+    '''
+    Decodes a DataFrame encoded by frame_to_json
+    '''
+    columns = {column: [Utterance(*utt) for utt in values] if column == 'utt' else values
+               for column, values in frame['columns'].items()}
+    return pd.DataFrame(columns, index=frame['index'])
+
+def pass_frame(frame, job_id):
+    '''
+    Encodes frame for a sub-invocation event or response, writing it to S3 under map_folder instead
+    when it is larger than map_payload_bytes
+    :return: dict with the encoded frame under frame, or its key under frame_key
+    '''
+    encoded = frame_to_json(frame)
+    body = json.dumps(encoded)
+    if len(body) <= map_payload_bytes:
+        return {'frame': encoded}
+    key = f'{map_folder}/{job_id}/{uuid.uuid4().hex}.json'
+    put_object(get_s3_client(), bucket, key, body)
+    count('map_s3_bytes', len(body))
+    return {'frame_key': key}
+
+def take_frame(message):
+    '''
+    Decodes the frame of a message built by pass_frame
+    '''
+    if 'frame_key' not in message:
+        return frame_from_json(message['frame'])
+    return frame_from_json(json.loads(get_object(get_s3_client(), bucket, message['frame_key'])['body']))
+
+def run_task(name, frame, job_id):
+    '''
+    Runs map task name in a worker process or sub-invocation, measuring it on its own
+    :return: the result of the task and its metrics, see metrics.merge
+    '''
+    return run_measured(job_id, map_tasks[name], frame, job_id)
+
+def run_task_json(event):
+    '''
+    Runs the map task of a sub-invocation event sent by invoke_task
+    '''
+    (frame, failed), snapshot = run_task(event['map'], take_frame(event), event['job_id'])
+    return {**pass_frame(frame, event['job_id']), 'failed': failed, 'metrics': snapshot}
+
+def invoke_task(name, frame, job_id):
+    '''
+    Runs map task name as a synchronous sub-invocation of map_function, this function by default.
+    Frames too large for the invoke payload go through S3 both ways, and are deleted here once read.
+    :return: the result of the task and its metrics
+    '''
+    event = {'map': name, 'job_id': job_id, **pass_frame(frame, job_id)}
+    keys = [event['frame_key']] if 'frame_key' in event else []
+    try:
+        response = get_lambda_client().invoke(FunctionName=map_function or os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+                                              Payload=json.dumps(event))
+        result = json.loads(response['Payload'].read())
+        if 'FunctionError' in response:
+            raise RuntimeError(f'Map task {name} of {job_id} failed: {result}')
+        if 'frame_key' in result:
+            keys.append(result['frame_key'])
+        frame = take_frame(result)
+    finally:
+        if keys:
+            delete_objects(get_s3_client(), bucket, keys)
+    return (frame, result['failed']), result['metrics']
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    '''
+    Returns the local process pool of 'processes' map mode, started on first use and kept for later chunks.
+    Workers are spawned rather than forked, since the clients and locks of this process must not be shared.
+    '''
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=map_workers, mp_context=multiprocessing.get_context('spawn'))
+        return process_pool
+
+def run_map(name, frames, job_id):
+    '''
+    Runs map task name over frames where map_mode says: in this process, on a local process pool,
+    or as sub-invocations of this function. Metrics of tasks run elsewhere are merged into the current job.
+    :return: list of resulting DataFrames, in the order of frames, and [created_at, unit_id, error]
+             of the units the tasks failed on
+    '''
+    with stage(f'map_{name}'):
+        if map_mode == 'inline' or len(frames) == 1:
+            outputs = [(map_tasks[name](frame, job_id), None) for frame in frames]
+        elif map_mode == 'processes':
+            outputs = list(get_process_pool().map(run_task, [name] * len(frames), frames, [job_id] * len(frames)))
+        elif map_mode == 'lambda':
+            with ThreadPoolExecutor(max_workers=map_workers) as executor:
+                outputs = list(executor.map(in_context(lambda frame: invoke_task(name, frame, job_id)), frames))
+        else:
+            raise ValueError(f'Unknown map_mode {map_mode}')
+    results = []
+    failed = []
+    for (frame, frame_failed), snapshot in outputs:
+        if snapshot is not None:
+            merge(snapshot)
+        results.append(frame)
+        failed += frame_failed
+    return results, failed
+
+def dead_letter(job_1, job_2, units):
+    '''
+    Writes units given up on to dead_letter_folder, one object per unit
+    :param units: dicts with the _unit_id, _created_at, error, runs and first_failed_at of each unit
+    :return: ids of the units written
+    '''
+    keys = {f'{dead_letter_folder}/{job_1}/{unit["_unit_id"]}.json': unit for unit in units}
+    rows = [(key, json.dumps({**unit, 'qa_job': int(job_2)})) for key, unit in keys.items()]
+    written = set()
+    for result in put_objects(get_s3_client(), bucket, rows, host_workers):
+        unit = keys[result['key']]
+        if result['status'] != 'success':
+            logger.info(f'Could not dead-letter unit {unit["_unit_id"]} of {job_1}: {result["status"]}')
+            continue
+        logger.info(f'Gave up on unit {unit["_unit_id"]} of {job_1} after {unit["runs"]} runs: {unit["error"]}')
+        written.add(unit['_unit_id'])
+    count('dead_letters', len(written))
+    return written
+
+def give_up(job_1, job_2, failed, failures):
+    '''
+    Counts a failed run for every unit in failed. Units that have now failed on unit_tries runs, or first
+    failed more than unit_retry_s ago, are dead-lettered so the watermark can pass them.
+    :param failed: [created_at, unit_id, error] of the units the map tasks failed on
+    :param failures: [created_at, unit_id, runs, first_failed_at] of the units that failed on earlier runs
+    :return: failed without the units dead-lettered, and failures with this run counted
+    '''
+    if not failed:
+        return failed, failures
+    now = time.time()
+    failures = {row[1]: row for row in failures}
+    # A unit fails once per utterance when hosting, and is counted once
+    errors = {}
+    for created_at, unit, error in failed:
+        errors.setdefault(unit, (created_at, error))
+    dead = []
+    for unit, (created_at, error) in errors.items():
+        _, _, runs, first_failed_at = failures.get(unit, (created_at, unit, 0, now))
+        failures[unit] = [created_at, unit, runs + 1, first_failed_at]
+        if runs + 1 >= unit_tries or now - first_failed_at > unit_retry_s:
+            dead.append({'_unit_id': unit, '_created_at': created_at, 'error': error, 'runs': runs + 1,
+                         'first_failed_at': first_failed_at})
+    written = dead_letter(job_1, job_2, dead) if dead else set()
+    return [row for row in failed if row[1] not in written], list(failures.values())
+
+def oldest_failed(failed, cutoff=None):
+    '''
+    Earliest of cutoff and the creation times in failed, None if there are neither
+    '''
+    if failed:
+        earliest = pd.to_datetime(pd.Series([row[0] for row in failed])).min()
+        cutoff = earliest if cutoff is None else min(cutoff, earliest)
+    return cutoff
+
+def before(df, cutoff):
+    '''
+    Keeps the utterances of df whose unit was created before cutoff, all of them when cutoff is None
+    '''
+    if cutoff is None:
+        return df
+    return df[pd.to_datetime(df['orig_created_at'].astype(str)).to_numpy() < cutoff.to_datetime64()].copy()
+
+def process_chunk(df1, job_1, job_2, sample_pct, title, seed, uploaded=(), failures=()):
+    '''
+    Plans one chunk of new origin job units into map tasks that fetch and pair their utterances,
+    samples the paired utterances, hosts the sample in map tasks again and uploads it to the QA job at once.
+    Units from the oldest one a map task failed on are left out, so the watermark never passes them,
+    unless give_up dead-lettered it.
+    :param uploaded: [orig_created_at, utterance_transcribed] of rows job_2 already accepted, which are not sent again
+    :param failures: units that failed on earlier runs, see give_up
+    :return: None if the upload failed, else how many of the chunk's rows were handled, oldest first,
+             [orig_created_at, utterance_transcribed] of the rows job_2 accepted, and failures with this run counted
+    '''
+    created_at = df1['_created_at_dt'].to_numpy()
+    frames, failed = run_map('fetch_pair', plan(df1.drop(columns=['_created_at_dt']), map_rows), job_1)
+    # The Utterances keep the parts of the annotations still needed, the rest goes with the unit rows
+    del df1
+    df = pd.concat(frames, ignore_index=True)
+    del frames
+    failed, failures = give_up(job_1, job_2, failed, failures)
+    cutoff = oldest_failed(failed)
+    df = before(df, cutoff)
+    handled = len(created_at) if cutoff is None else int(np.searchsorted(created_at, cutoff.to_datetime64()))
+    if len(df) == 0:
+        if cutoff is None:
+            print('All new utterances were marked as "Nothing to Annotate"')
+        return handled, [], failures
+    with stage('sample'):
+        df = sample(df, sample_pct, seed)
+    count('sampled', len(df))
+    frames, failed = run_map('host', plan(df, map_rows), job_1)
+    df = pd.concat(frames)
+    failed, failures = give_up(job_1, job_2, failed, failures)
+    if failed:
+        cutoff = oldest_failed(failed, cutoff)
+        df = before(df, cutoff)
+        handled = int(np.searchsorted(created_at, cutoff.to_datetime64()))
+    df['orig_job_id'] = job_1
+    df = df.drop(columns=['utt'])
+    df['from_job_name'] = title
+    sent = df['utterance_transcribed'].isin({path for _, path in uploaded})
+    if sent.any():
+        logger.info(f'{sent.sum()} rows were accepted by {job_2} on an earlier run and are not sent again')
+        df = df[~sent]
+    
+    df_len = len(df)
+    print(f'Uploading {df_len} rows to {job_2}')
+    with stage('upload'):
+        results = upload_report(df, job_2)
+    accepted = sum(rows for rows, res in results if res.status_code == 200)
+    logger.info(f'{job_2} accepted {[rows if res.status_code == 200 else 0 for rows, res in results]} rows per upload')
+    count('uploaded_rows', accepted)
+    # Requests stop at the first one not accepted, so the accepted rows come first
+    accepted = df.iloc[:accepted]
+    accepted = [[str(created_at), path] for created_at, path in zip(accepted['orig_created_at'], accepted['utterance_transcribed'])]
+    if len(accepted) < df_len:
+        logger.info(f'Upload to {job_2} failed, keeping the watermark of {job_1}')
+        return None, accepted, failures
+    
+    return handled, accepted, failures
@@ -0,0 +1,78 @@
+'''
+Watermark of a source job across timer ticks, run against the stand-ins of benchmarks/standins.py
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+sys.path.insert(0, os.path.join(repo, 'benchmarks'))
+
+from standins import FakeS3, AppenStandIn, make_jobs
+
+api = None
+
+
+def setUpModule():
+    global api, lambda_function, pipeline
+    os.environ.setdefault('API_KEY', 'test')
+    import lambda_function
+    lambda_function.clients['s3'] = FakeS3()
+    lambda_function.watermark_store = 'file'
+    lambda_function.watermark_folder = tempfile.mkdtemp()
+    api = AppenStandIn().__enter__()
+    lambda_function.api_url = f'{api.url}/v1'
+    # pipeline copies its settings from lambda_function when first imported
+    import pipeline
+    pipeline.anno_cache = pipeline.AnnotationCache(16, tempfile.mkdtemp(), 1024 * 1024)
+
+
+def tearDownModule():
+    api.__exit__(None, None, None)
+
+
+def webhook_unit(row):
+    '''
+    A unit_complete payload unit for a full report row built by make_jobs
+    '''
+    return {'id': int(row['_unit_id']), 'job_id': 1000,
+            'data': {column: row[column] for column in ['audio_annotation_url', 'audio_url', 'display_id', 'duration',
+                                                         'pe_file_id', 'pe_file_name', 'pe_store_id', 'qa_job', 'sample']},
+            'results': {'judgments': [{'created_at': row['_created_at'] + '+00:00', 'worker_id': row['_worker_id'],
+                                       'data': {'tx_work': row['tx_work']}}]}}
+
+
+class QueuedUnitsTest(unittest.TestCase):
+
+    def test_full_report_moves_timestamp_over_queued_units(self):
+        s3 = lambda_function.clients['s3']
+        full = make_jobs(s3, api, 4, 2, new_fraction=0.5, sample=1.0)
+        # Reconciled just now, so the next tick samples from the queue
+        pipeline.watermarks.put('1000', {'qa_job': 2000, 'timestamp': full['_created_at'][1],
+                                         'reconciled_at': time.time()})
+        lambda_function.queue_units('1000', [webhook_unit(row) for _, row in full[2:].iterrows()],
+                                    lambda_function.bucket, lambda_function.queue_folder)
+
+        self.assertTrue(pipeline.job_handler('1000'))
+        watermark = pipeline.watermarks.get('1000')
+        self.assertEqual(watermark['timestamp'], full['_created_at'][1])
+        self.assertEqual([unit for _, unit in watermark['queued']], ['2', '3'])
+        uploads = len(api.uploads)
+        self.assertEqual(uploads, 1)
+        self.assertFalse(list(pipeline.list_keys(s3, lambda_function.bucket, lambda_function.queue_folder)))
+
+        # New judgments regenerate the full report, which holds the queued units by now
+        self.assertTrue(pipeline.job_handler('1000', metadata={'judgments': 2}))
+        watermark = pipeline.watermarks.get('1000')
+        self.assertEqual(watermark['timestamp'], full['_created_at'][3])
+        self.assertEqual(watermark['queued'], [])
+        self.assertEqual(len(api.uploads), uploads)
+
+
+if __name__ == '__main__':
+    unittest.main()
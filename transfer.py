@@ -0,0 +1,211 @@
+import io
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# S3 transfers shared by the Lambda and the batch scripts: paginated listing that yields objects as
+# pages arrive, single object reads, writes and deletes with one result dict per object, and bulk
+# versions of each running on a bounded thread pool. Bodies and files above multipart_threshold go
+# through boto3's managed transfer in multipart_chunksize parts. Every function takes the S3 client
+# to use, so callers keep their own pooled client and retry settings.
+# Standard library only until an S3 call is made, so the webhook path stays light.
+
+
+# Internal settings:
+
+workers = 16  # Objects transferred at once by the bulk functions
+multipart_threshold = 64 * 1024 * 1024  # Bodies and files at least this large are sent and fetched in parts
+multipart_chunksize = 16 * 1024 * 1024  # Size of each part of a multipart transfer
+multipart_workers = 8  # Parts of one multipart transfer sent at once
+delete_batch = 1000  # Most keys one DeleteObjects request may take
+
+# Error codes S3 answers a conditional or missing object with
+missing_codes = ('NoSuchKey', '404', 'NotFound')
+not_modified_codes = ('304', 'NotModified')
+exists_codes = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                          max_concurrency=multipart_workers)
+
+
+def error_code(e):
+    response = getattr(e, 'response', None) or {}
+    return str(response.get('Error', {}).get('Code', ''))
+
+
+def list_objects(client, bucket, prefix, page_size=1000):
+    '''
+    Lists the objects under prefix page by page, yielding each page's objects before the next is requested
+    :return: generator of object dicts (Key, Size, ETag, LastModified, ...)
+    '''
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+    while True:
+        response = client.list_objects_v2(**kwargs)
+        yield from response.get('Contents', [])
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def list_keys(client, bucket, prefix, page_size=1000):
+    '''
+    Keys of the objects under prefix, leaving out folder placeholders ending in /
+    :return: generator of keys
+    '''
+    return (obj['Key'] for obj in list_objects(client, bucket, prefix, page_size) if not obj['Key'].endswith('/'))
+
+
+def get_object(client, bucket, key, **kwargs):
+    '''
+    Reads one object whole
+    :param kwargs: passed on to get_object, e.g. IfNoneMatch
+    :return: dict with key and status: 'success' with body (bytes), etag and retries, 'missing' or 'not_modified'.
+             Other errors are raised.
+    '''
+    from botocore.exceptions import ClientError
+    try:
+        obj = client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as e:
+        if error_code(e) in missing_codes:
+            return {'key': key, 'status': 'missing'}
+        if error_code(e) in not_modified_codes:
+            return {'key': key, 'status': 'not_modified'}
+        raise
+    return {'key': key, 'status': 'success', 'body': obj['Body'].read(), 'etag': obj.get('ETag'),
+            'retries': obj['ResponseMetadata'].get('RetryAttempts', 0)}
+
+
+def put_object(client, bucket, key, body, **kwargs):
+    '''
+    Writes one object, in parts when body is at least multipart_threshold and no condition is given
+    :param body: bytes or str
+    :param kwargs: passed on to put_object, e.g. IfNoneMatch='*' to only create the object
+    :return: dict with key, bytes and status: 'success' with etag and retries, or 'exists' when IfNoneMatch
+             found the object already there. Other errors are raised.
+    '''
+    from botocore.exceptions import ClientError
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if len(body) >= multipart_threshold and 'IfNoneMatch' not in kwargs:
+        client.upload_fileobj(io.BytesIO(body), bucket, key, ExtraArgs=kwargs or None, Config=transfer_config())
+        return {'key': key, 'status': 'success', 'bytes': len(body), 'etag': None, 'retries': 0}
+    try:
+        response = client.put_object(Bucket=bucket, Key=key, Body=body, **kwargs)
+    except ClientError as e:
+        if error_code(e) in exists_codes:
+            return {'key': key, 'status': 'exists', 'bytes': 0}
+        raise
+    return {'key': key, 'status': 'success', 'bytes': len(body), 'etag': response.get('ETag'),
+            'retries': response['ResponseMetadata'].get('RetryAttempts', 0)}
+
+
+def bounded(func, items, max_workers=None):
+    '''
+    Runs func on every item on a pool of max_workers threads, keeping at most 2 x max_workers items
+    in flight, so items may be a generator of any length. func runs in a copy of the caller's context.
+    :return: generator of (item, result, exception) in completion order
+    '''
+    max_workers = max_workers or workers
+    items = iter(items)
+    context = contextvars.copy_context()
+
+    def run(item):
+        try:
+            return item, context.copy().run(func, item), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        running = set()
+        for item in items:
+            running.add(executor.submit(run, item))
+            if len(running) >= 2 * max_workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in running:
+            yield future.result()
+
+
+def failed(key, e):
+    return {'key': key, 'status': e}
+
+
+def get_objects(client, bucket, keys, max_workers=None):
+    '''
+    Reads many objects at once, see get_object
+    :return: generator of result dicts in completion order, status is the exception for objects that failed
+    '''
+    for key, result, e in bounded(lambda key: get_object(client, bucket, key), keys, max_workers):
+        yield result if e is None else failed(key, e)
+
+
+def put_objects(client, bucket, items, max_workers=None, **kwargs):
+    '''
+    Writes many objects at once, see put_object
+    :param items: iterable of (key, body)
+    :return: generator of result dicts in completion order, status is the exception for objects that failed
+    '''
+    for (key, _), result, e in bounded(lambda item: put_object(client, bucket, *item, **kwargs), items, max_workers):
+        yield result if e is None else failed(key, e)
+
+
+def delete_objects(client, bucket, keys):
+    '''
+    Deletes keys delete_batch at a time
+    :return: list of result dicts of the keys that could not be deleted
+    '''
+    keys = list(keys)
+    errors = []
+    for start in range(0, len(keys), delete_batch):
+        objects = [{'Key': key} for key in keys[start:start + delete_batch]]
+        try:
+            response = client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        except Exception as e:
+            errors += [failed(obj['Key'], e) for obj in objects]
+            continue
+        errors += [failed(error['Key'], error.get('Message') or error.get('Code')) for error in response.get('Errors', [])]
+    return errors
+
+
+def download_files(client, bucket, keys, dst_dir, max_workers=None):
+    '''
+    Downloads many objects into dst_dir, each under its base name. Objects of multipart_threshold
+    or more are fetched in ranged parts.
+    :return: generator of result dicts in completion order: file, key, downloaded_to and status ('success' or the exception)
+    '''
+    config = transfer_config()
+    os.makedirs(dst_dir, exist_ok=True)
+
+    def download(key):
+        path = os.path.join(dst_dir, os.path.basename(key))
+        client.download_file(bucket, key, path, Config=config)
+        return path
+
+    for key, path, e in bounded(download, keys, max_workers):
+        result = {'file': os.path.basename(key), 'key': key}
+        yield {**result, 'downloaded_to': path, 'status': 'success'} if e is None else {**result, 'status': e}
+
+
+def upload_files(client, bucket, paths, dst_dir, max_workers=None):
+    '''
+    Uploads many local files under the dst_dir prefix, each under its base name. Files of
+    multipart_threshold or more are sent in parts.
+    :return: generator of result dicts in completion order: filename, uploaded_to, url and status ('success' or the exception)
+    '''
+    config = transfer_config()
+
+    def upload(path):
+        key = os.path.join(dst_dir, os.path.basename(path))
+        client.upload_file(path, bucket, key, Config=config)
+        return key
+
+    for path, key, e in bounded(upload, paths, max_workers):
+        result = {'filename': os.path.basename(path)}
+        if e is not None:
+            yield {**result, 'status': e}
+        else:
+            yield {**result, 'uploaded_to': key, 'status': 'success', 'url': f'https://{bucket}.s3.amazonaws.com/{key}'}
@@ -2,8 +2,6 @@ import urllib
 import numpy as np
 import pandas as pd
 import cv2 
-from functools import partial
-from multiprocessing import  Pool
 import json
 import sys
 from shapely.geometry import Polygon
@@ -13,8 +11,66 @@ from pathlib import Path
 import urllib
 from urllib.request import Request, urlopen
 import boto3
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 sys.path.append('../qa_images/')
 from imgAnno import create_img
+from transfer import list_keys, download_files, upload_files
+import parallel
+
+image_cache_items = 16  # Decoded images url_to_image keeps, shared by every create_img
+image_cache_bytes = 1024 * 1024 * 1024  # Most bytes of decoded images kept
+render_workers = os.cpu_count() or 4  # Threads rendering, encoding and writing views
+fetch_workers = 16  # Threads downloading and decoding images in render_batch
+
+
+class ImageCache:
+    '''
+    Least recently used decoded images, at most max_items of them holding at most max_bytes.
+    Cached arrays are read only, callers copy before drawing on them.
+    '''
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        img.flags.writeable = False
+        with self.lock:
+            old = self.images.pop(key, None)
+            self.bytes += img.nbytes - (old.nbytes if old is not None else 0)
+            self.images[key] = img
+            while self.images and (len(self.images) > self.max_items or self.bytes > self.max_bytes):
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+
+decoded_images = ImageCache(image_cache_items, image_cache_bytes)
+jwt_hosts = set()  # Hosts that answered an image request without the JWT token with an error
+render_pool = None
+render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    global render_pool
+    with render_pool_lock:
+        if render_pool is None:
+            render_pool = ThreadPoolExecutor(render_workers)
+        return render_pool
+
 
 class create_img():
     ''' 
@@ -28,11 +84,15 @@ class create_img():
         - wordbox() = Images of wordbox SHADED and wordline BOXED
         - wordline_wordbox() = Images of both wordbox and wordline are SHADED
         - def annotated_images() = Images of both wordbox and wordline BOXED
+        - render_views(views) = Any of the above from one download and decode of the image
     EXAMPLE:
         create_img(img_name,elements,img_input,img_output).wordline()
         OR
         create_img_obj = create_img(img_name,elements,img_input,img_output)
         create_img_obj.wordline()
+        OR
+        create_img(img_name,elements,img_input,img_output,jwt_token).render_views(['wordline', 'wordbox'])
+        render_batch([create_img(...), ...])
     '''
 
     def __init__(self, img_name, elements, img_input, img_output, jwt_token, link=False):
@@ -43,177 +103,211 @@ class create_img():
         self.link = link  # Link defaults to False and searches for local files; If it's True it looks for image in url
         self.jwt_token = jwt_token
 
-    def url_to_image(self, readFlag=cv2.IMREAD_COLOR):
+    def image_key(self, readFlag):
         if 'http' not in self.img_input:
-            img = cv2.imread(f'{self.img_input}/{self.img_name}.jpg', cv2.IMREAD_COLOR)
-            return img
+            return (f'{self.img_input}/{self.img_name}.jpg', readFlag)
+        return (self.img_input, readFlag)
 
-        elif 'http' in self.img_input:
-            try:
-                req = Request(self.img_input)
-                resp = urlopen(req)
-            except:
-                req = Request(self.img_input)
-                req.add_header('x-cf-jwt-token', self.jwt_token)
-                resp = urlopen(req)
-            image = np.asarray(bytearray(resp.read()), dtype="uint8")
-            img = cv2.imdecode(image, readFlag)
-            # return the image
+    def fetch(self, readFlag=cv2.IMREAD_COLOR):
+        if 'http' not in self.img_input:
+            img = cv2.imread(f'{self.img_input}/{self.img_name}.jpg', readFlag)
             return img
-            # resp = urllib.request.urlopen(self.img_input)
-            # img = np.asarray(bytearray(resp.read()), dtype="uint8")
-            # img = cv2.imdecode(img, readFlag)
-            # #return the image
-            # return img
+
+        # Hosts known to want the token get it on the first request instead of after a failed one
+        host = urlparse(self.img_input).netloc
+        try:
+            resp = urlopen(self.request(host in jwt_hosts))
+        except Exception:
+            if host in jwt_hosts:
+                raise
+            resp = urlopen(self.request(True))
+            jwt_hosts.add(host)
+        image = np.asarray(bytearray(resp.read()), dtype="uint8")
+        img = cv2.imdecode(image, readFlag)
+        # return the image
+        return img
+
+    def request(self, with_token):
+        req = Request(self.img_input)
+        if with_token:
+            req.add_header('x-cf-jwt-token', self.jwt_token)
+        return req
+
+    def decode(self, readFlag=cv2.IMREAD_COLOR):
+        '''
+        Fetches and decodes the image once, later calls for the same image hit decoded_images
+        :return: read only image shared with other callers, None if it could not be decoded
+        '''
+        key = self.image_key(readFlag)
+        img = decoded_images.get(key)
+        if img is None:
+            img = self.fetch(readFlag)
+            if img is not None:
+                decoded_images.put(key, img)
+        return img
+
+    def url_to_image(self, readFlag=cv2.IMREAD_COLOR):
+        img = self.decode(readFlag)
+        return img.copy() if img is not None else None
+
+    # Layers each view draws, in order: (class, outline color, shade color, opacity, thickness).
+    # A shaded layer has its outlines drawn first and half blended with the shade, like draw_fillpoly.
+    views = {
+        'wordline': ('Wordline', [('LINE', (0, 128, 0), (0, 128, 0), 0.2, 1),
+                                  ('DOCUMENT_CONTENT_AREA', (0, 255, 0), None, 0.0, 2)]),
+        'wordbox': ('Wordbox', [('WORD', (0, 0, 0), (0, 0, 0), 0.5, 2),
+                                ('WORD', (0, 0, 0), None, 0.0, 2),
+                                ('LINE', (0, 128, 0), None, 0.0, 2),
+                                ('DOCUMENT_CONTENT_AREA', (0, 255, 0), None, 0.0, 2)]),
+        'wordline_wordbox': ('AllBoxShaded', [('WORD', (0, 0, 0), (0, 0, 0), 0.5, 2),
+                                              ('LINE', (0, 128, 0), None, 0.0, 2),
+                                              ('DOCUMENT_CONTENT_AREA', (0, 255, 0), None, 0.0, 2)]),
+        'annotated_images': ('AnnotatedImages', [('WORD', (0, 0, 255), None, 0.0, 2),
+                                                 ('LINE', (0, 128, 0), None, 0.0, 2),
+                                                 ('DOCUMENT_CONTENT_AREA', (0, 255, 0), None, 0.0, 2)]),
+    }
+
+    def scale_polygons(self, elements, img):
+        '''
+        Scales the first four relative polygon points of every element to pixels in one NumPy pass
+        :return: int32 array of shape (elements, 4, 2)
+        '''
+        points = np.array([[(point['x'], point['y']) for point in element['polygon'][:4]] for element in elements],
+                          dtype=np.float64).reshape(-1, 4, 2)
+        points *= (img.shape[1], img.shape[0])
+        return points.astype(np.int32)
+
+    def scale_boxes(self, elements, img):
+        '''
+        Scales the relative bbox of every element to pixel corners in one NumPy pass
+        :return: int array of shape (elements, 4) holding x, y, x2, y2
+        '''
+        boxes = np.array([(element['bbox']['x'], element['bbox']['y'], element['bbox']['width'],
+                           element['bbox']['height']) for element in elements], dtype=np.float64).reshape(-1, 4)
+        boxes *= (img.shape[1], img.shape[0], img.shape[1], img.shape[0])
+        boxes = boxes.astype(int)
+        boxes[:, 2:] += boxes[:, :2]
+        return boxes
 
     def draw_poly(self, element, img, color, thickness):
-        new_coordinates = []
-        for i in range(0, 4):
-            new_coordinates.append(
-                [element['polygon'][i]['x']*img.shape[1], element['polygon'][i]['y'] * img.shape[0]])
-        cv2.polylines(
-            img, [np.array(new_coordinates, np.int32)], True, color, thickness)
+        cv2.polylines(img, list(self.scale_polygons([element], img)), True, color, thickness)
 
     def draw_fillpoly(self, element, img, overlay, color_line, color_shade, opacity, thickness):
-        new_coordinates = []
-        for i in range(0, 4):
-            new_coordinates.append(
-                [element['polygon'][i]['x']*img.shape[1], element['polygon'][i]['y'] * img.shape[0]])
-
-        cv2.polylines(img, [np.array(new_coordinates, np.int32)],
-                      True, color_line, thickness)
-        cv2.fillPoly(
-            overlay, [np.array(new_coordinates, np.int32)], (color_shade))
+        polygons = self.scale_polygons([element], img)
+        cv2.polylines(img, list(polygons), True, color_line, thickness)
+        cv2.fillPoly(overlay, list(polygons), (color_shade))
         cv2.addWeighted(overlay, opacity, img, 1 - opacity, 0, img)
 
     def draw_box(self, element, img, color, thickness):
-        x = int(element['bbox']['x'] * img.shape[1])
-        y = int(element['bbox']['y'] * img.shape[0])
-        x2 = x + int(element['bbox']['width'] * img.shape[1])
-        y2 = y + int(element['bbox']['height'] * img.shape[0])
-        cv2.rectangle(img, (x, y), (x2, y2), color, thickness)
-
-    def wordline(self):
-        output_dir = '{}/Wordline'.format(self.img_output)
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        img = self.url_to_image()
-
+        x, y, x2, y2 = self.scale_boxes([element], img)[0]
+        cv2.rectangle(img, (int(x), int(y)), (int(x2), int(y2)), color, thickness)
+
+    def render(self, img, view):
+        '''
+        Draws the layers of view onto img in place. A shaded layer fills all its polygons into
+        one overlay and blends it with a single addWeighted, whatever the number of elements.
+        Overlapping polygons of one layer are shaded once rather than darkening each other.
+        :param view: key of create_img.views
+        :return: img
+        '''
+        by_class = {}
         for element in self.elements:
-            # color = (0,0,0)
-            color_line = (0, 0, 0)
-            color_shade = (0, 0, 0)
-            overlay = img.copy()
-
-            if element['class'] == 'WORD':
+            by_class.setdefault(element['class'], []).append(element)
+        for element_class, color_line, color_shade, opacity, thickness in self.views[view][1]:
+            elements = by_class.get(element_class)
+            if not elements:
                 continue
-
-            elif element['class'] == "LINE":
-                # color = (0, 128, 0)
-                color_line = (0, 128, 0)
-                color_shade = (0, 128, 0)
-                opacity = 0.2
-                thickness = 1
-                self.draw_fillpoly(element, img, overlay,
-                                   color_line, color_shade, opacity, thickness)
-
-            elif element['class'] == "DOCUMENT_CONTENT_AREA":
-                self.draw_box(element, img, (0, 255, 0), 2)
-
+            if element_class == 'DOCUMENT_CONTENT_AREA':
+                for x, y, x2, y2 in self.scale_boxes(elements, img):
+                    cv2.rectangle(img, (int(x), int(y)), (int(x2), int(y2)), color_line, thickness)
+                continue
+            polygons = list(self.scale_polygons(elements, img))
+            overlay = img.copy() if opacity else None
+            cv2.polylines(img, polygons, True, color_line, thickness)
+            if opacity:
+                # One fillPoly per polygon: a single call fills overlapping polygons even-odd and leaves holes
+                for polygon in polygons:
+                    cv2.fillPoly(overlay, [polygon], color_shade)
+                cv2.addWeighted(overlay, opacity, img, 1 - opacity, 0, img)
+        return img
+
+    def write_view(self, img, view):
+        output_dir = '{}/{}'.format(self.img_output, self.views[view][0])
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
         cv2.imwrite(f'{output_dir}/{self.img_name}.jpg', img)
+        return f'{output_dir}/{self.img_name}.jpg'
+
+    def render_view(self, img, view):
+        return self.write_view(self.render(img.copy(), view), view)
+
+    def render_views(self, views=None, executor=None, img=None):
+        '''
+        Renders any set of views from one fetch and decode of the image. Each view is drawn on
+        its own copy, encoded and written on executor.
+        :param views: keys of create_img.views, all of them if None
+        :param executor: pool to render and write on, get_render_pool() if None
+        :param img: decoded image to render, self.decode() if None
+        :return: dict of view -> future of the written path
+        '''
+        img = self.decode() if img is None else img
+        executor = executor or get_render_pool()
+        return {view: executor.submit(self.render_view, img, view) for view in views or self.views}
+
+    def wordline(self):
+        img = self.render(self.url_to_image(), 'wordline')
+        self.write_view(img, 'wordline')
         print('Image {}.jpg of wordline shaded created\n'.format(self.img_name))
 
     def wordbox(self):
-        output_dir = '{}/Wordbox'.format(self.img_output)
-        # print(output_dir)
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        img = self.url_to_image()
-        for element in self.elements:
-            # color = (0,0,0)
-            color_line = (0, 0, 0)
-            color_shade = (0, 0, 0)
-            overlay = img.copy()
-
-            if element['class'] == 'WORD':
-                color_line = (0, 0, 0)
-                color_shade = (0, 0, 0)
-                opacity = 0.5
-                thickness = 2
-                self.draw_fillpoly(element, img, overlay,
-                                   color_line, color_shade, opacity, thickness)
-                self.draw_poly(element, img, color_line, thickness)
-
-            elif element['class'] == "LINE":
-                color = (0, 128, 0)
-                opacity = 0.0
-                thickness = 2
-                self.draw_poly(element, img, color, thickness)
-
-            elif element['class'] == "DOCUMENT_CONTENT_AREA":
-                self.draw_box(element, img, (0, 255, 0), 2)
-
-        cv2.imwrite(f'{output_dir}/{self.img_name}.jpg', img)
+        img = self.render(self.url_to_image(), 'wordbox')
+        self.write_view(img, 'wordbox')
         print('Image {}.jpg of wordbox shaded created\n'.format(self.img_name))
 
     def wordline_wordbox(self):
-        output_dir = '{}/AllBoxShaded'.format(self.img_output)
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        img = self.url_to_image()
-        for element in self.elements:
-            color = (0, 0, 0)
-            # overlay = self.url_to_image()
-            overlay = img.copy()
-            if element['class'] == 'WORD':
-                color = (0, 0, 0)
-                color_line = (0, 0, 0)
-                color_shade = (0, 0, 0)
-                opacity = 0.5
-                thickness = 2
-                self.draw_fillpoly(element, img, overlay,
-                                   color_line, color_shade, opacity, thickness)
-
-            elif element['class'] == "LINE":
-                color = (0, 128, 0)
-                color_line = (0, 128, 0)
-                color_shade = (0, 128, 0)
-                opacity = 0.0
-                thickness = 2
-                self.draw_fillpoly(element, img, overlay,
-                                   color_line, color_shade, opacity, thickness)
-
-            elif element['class'] == "DOCUMENT_CONTENT_AREA":
-                self.draw_box(element, img, (0, 255, 0), 2)
-
-        cv2.imwrite(f'{output_dir}/{self.img_name}.jpg', img)
-        print(f'{output_dir}/{self.img_name}.jpg')
+        img = self.render(self.url_to_image(), 'wordline_wordbox')
+        print(self.write_view(img, 'wordline_wordbox'))
 
     def annotated_images(self):
-        output_dir = f'{self.img_output}/AnnotatedImages'
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        img = self.url_to_image()
-        for element in self.elements:
-            color = (0, 0, 0)
-
-            if element['class'] == 'WORD':
-                color = (0, 0, 255)
-                self.draw_poly(element, img, color, 2)
-
-            elif element['class'] == "LINE":
-                color = (0, 128, 0)
-                self.draw_poly(element, img, color, 2)
+        img = self.render(self.url_to_image(), 'annotated_images')
+        self.write_view(img, 'annotated_images')
+        print(f'Annotated image {self.img_name}.jpg created\n')
 
-            elif element['class'] == "DOCUMENT_CONTENT_AREA":
-                self.draw_box(element, img, (0, 255, 0), 2)
 
-        cv2.imwrite(f'{output_dir}/{self.img_name}.jpg', img)
-        print(f'Annotated image {self.img_name}.jpg created\n')
+def render_batch(images, views=None):
+    '''
+    Renders views of many images. Up to 2 x fetch_workers images are downloaded and decoded ahead
+    while earlier ones are rendered and written on the render pool, and at most 2 x render_workers
+    images wait to be rendered, so memory stays bounded however long images is.
+    :param images: create_img objects
+    :param views: keys of create_img.views, all of them if None
+    :return: list of dicts of view -> written path in images order, {} where the image could not be read
+    '''
+    images = iter(images)
+    executor = get_render_pool()
+    results = []
+    rendering = deque()
+    with ThreadPoolExecutor(fetch_workers) as fetchers:
+        fetching = deque((image, fetchers.submit(image.decode)) for image in islice(images, 2 * fetch_workers))
+        while fetching:
+            image, future = fetching.popleft()
+            for following in islice(images, 1):
+                fetching.append((following, fetchers.submit(following.decode)))
+            try:
+                img = future.result()
+            except Exception as e:
+                print(f'-- Unable to read image {image.img_name} -- {e}')
+                img = None
+            if img is None:
+                results.append({})
+                continue
+            written = image.render_views(views, executor, img)
+            results.append(written)
+            rendering.append(written)
+            while len(rendering) > 2 * render_workers:
+                for future in rendering.popleft().values():
+                    future.result()
+    return [{view: future.result() for view, future in written.items()} for written in results]
 
 
 def url_to_image_2(url, readFlag=cv2.IMREAD_COLOR):\
@@ -240,6 +334,8 @@ def read_img(path, filename):
             print(f'-- Unable to read image {filename}- url!')
     return img
 
+# For whole sets of elements, e.g. the words of two annotators, matching.overlaps and matching.match
+# compare only the pairs that touch and vectorize the geometry
 def calculate_iou(poly_1, poly_2):
     try:
         union = poly_1.union(poly_2).area
@@ -276,19 +372,16 @@ def write_json(anno, path, filename):
         json.dump(anno, f1)
 
 
-def parallelize(data, func, num_of_processes=16):
-    data_split = np.array_split(data, num_of_processes)
-    pool = Pool(num_of_processes)
-    data = pd.concat(pool.map(func, data_split))
-    pool.close()
-    pool.join()
-    return data
+# The pool is started once and kept between calls, with one worker per available core unless
+# num_of_processes is given. Chunks reach the workers through shared memory, see parallel.py.
+def parallelize(data, func, num_of_processes=None):
+    return parallel.parallelize(data, func, num_of_processes)
 
 def run_on_subset(func, data_subset):
     return data_subset.apply(func, axis=1)
 
-def parallelize_on_rows(data, func, num_of_processes=16):
-    return parallelize(data, partial(run_on_subset, func), num_of_processes)
+def parallelize_on_rows(data, func, num_of_processes=None):
+    return parallel.parallelize_on_rows(data, func, num_of_processes)
 
 df['image'] = parallelize_on_rows(df, main)
 
@@ -312,14 +405,15 @@ def init_session():
 
 
 def listObjects(s3, bucket_name, filepath):
-    """Get list of filepaths to objects in bucket_name, filepath
+    """Get list of filepaths to objects in bucket_name, filepath, page by page
 
     Args:
+        s3: resource from init_session
         bucket_name (str): s3 bucket name
         filepath (str): Path to folder
     """
     try:
-        list_object_key = [obj.key for obj in list(self.s3session.Bucket(self.bucket_name).objects.filter(Prefix=filepath)) if obj.key[-1] != '/']
+        list_object_key = list(list_keys(s3.meta.client, bucket_name, filepath))
         print(f'-- Found {len(list_object_key)} objects in {bucket_name}/{filepath}')
         return(list_object_key)
     except Exception as e:
@@ -327,6 +421,44 @@ def listObjects(s3, bucket_name, filepath):
         return([])
 
 
+def downloadObjects(s3, bucket_name, filepaths, dst_dir, workers=16):
+    """Download many objects from s3 Bucket at once, large ones in parts
+
+    Args:
+        bucket_name (str): s3 bucket name
+        filepaths (iterable of str): Paths to files in s3 Bucket, e.g. from listObjects
+        dst_dir (str): Path to local folder
+        workers (int): Objects downloaded at once
+    Returns:
+        list of one result per object, like downloadObject, in completion order
+    """
+    results = []
+    for result in download_files(s3.meta.client, bucket_name, filepaths, dst_dir, workers):
+        if result['status'] != 'success':
+            print(f'-- Encountered error when downloading {result["file"]} -- {result["status"]}')
+        results.append(result)
+    return(results)
+
+
+def uploadObjects(s3, bucket_name, filepaths, dst_dir, workers=16):
+    """Upload many files to s3 Bucket at once, large ones in parts
+
+    Args:
+        bucket_name (str): s3 bucket name
+        filepaths (iterable of str): Paths to local files that need to be uploaded
+        dst_dir (str): Path to s3 bucket
+        workers (int): Files uploaded at once
+    Returns:
+        list of one result per file, like uploadObject, in completion order
+    """
+    results = []
+    for result in upload_files(s3.meta.client, bucket_name, filepaths, dst_dir, workers):
+        if result['status'] != 'success':
+            print(f'-- ERROR: For {result["filename"]} -- {result["status"]}')
+        results.append(result)
+    return(results)
+
+
 def downloadObject(s3, bucket_name, filepath, dst_dir):
     """Download from s3 Bucket
 
@@ -335,14 +467,7 @@ def downloadObject(s3, bucket_name, filepath, dst_dir):
         filepath (str): Path to file in s3 Bucket
         dst_dir (str): Path to local folder
     """
-    filename = os.path.basename(filepath)
-    new_path = os.path.join(dst_dir, filename)
-    try:
-        s3.Bucket(bucket_name).download_file(filepath, new_path)
-        return({'file': filename, 'key': filepath, 'downloaded_to': new_path, 'status': 'success'})
-    except Exception as e:
-        print(f'-- Encountered error when downloading {filename} -- {e}')
-        return({'file': filename, 'key': filepath, 'status': e})
+    return(downloadObjects(s3, bucket_name, [filepath], dst_dir, 1)[0])
 
 
 def uploadObject(s3, bucket_name, filepath, dst_dir):
@@ -353,11 +478,4 @@ def uploadObject(s3, bucket_name, filepath, dst_dir):
         filepath (str): Path to local file that needs to be uploaded
         dst_dir (str): Path to s3 bucket
     """
-    filename = os.path.basename(filepath)
-    new_path = os.path.join(dst_dir, filename)
-    try:
-        s3.Bucket(bucket_name).upload_file(filepath, new_path)
-        return({'filename': filename, 'uploaded_to': new_path, 'status': 'success', 'url': f'https://{bucket_name}.s3.amazonaws.com/{new_path}'})
-    except Exception as e:
-        print(f'-- ERROR: For {filename} -- {e}')
-        return({'filename': filename, 'status': e})
\ No newline at end of file
+    return(uploadObjects(s3, bucket_name, [filepath], dst_dir, 1)[0])